@@ -9,6 +9,36 @@ class Config:
     CSRF_ENABLED = True
     WTF_CSRF_ENABLED = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Store each loaded source workbook in the metadata table.
+    SOURCE_DATA_BLOB = True
+    # Serve /datalab/data from an in-memory cube if NumPy is installed.
+    DATALAB_CUBE = True
+    # In-process cache of responses, in front of the cache table.
+    CACHE_LOCAL_MAX_BYTES = 64 * 1024 * 1024
+    CACHE_LOCAL_TTL = 60 * 60
+    # Budget for the total size of the cache table, and which records are
+    # evicted first when it is exceeded: 'lru' or 'lfu'.
+    CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    CACHE_EVICTION_POLICY = 'lru'
+    # Seconds between writes of hit counts to the cache table, per process.
+    CACHE_HITS_FLUSH_SECONDS = 60
+    # Seconds between trims of the cache table after saves, per process. The
+    # table may exceed its budget by what is saved in between.
+    CACHE_TRIM_SECONDS = 60
+    # Seconds a worker trusts its last look at the source data versions when
+    # answering conditional GET requests.
+    SOURCE_DATA_TTL = 10
+    # Seconds clients and proxies may reuse a response without revalidating.
+    CACHE_CONTROL_MAX_AGE = 5 * 60
+    # Most records a collection endpoint returns per request. Later records
+    # are reached through the 'next' link in the metadata.
+    PAGE_SIZE_MAX = 1000
+    # Directory of the full dataset export files, built by manage.py
+    # build_exports.
+    EXPORTS_DIR = os.path.join(basedir, 'exports')
+    # JSON encoder of responses: 'orjson', 'ujson', 'json' or 'auto' for the
+    # fastest one installed.
+    JSON_ENCODER = 'auto'
 
 
 class StagingConfig(Config):
@@ -29,10 +59,17 @@ class DevelopmentConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', SQLITE_URI)
 
 
+class TestingConfig(Config):
+    """Testing configuration."""
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
     'staging': StagingConfig,
+    'testing': TestingConfig,
     # And the default is...
     'default': DevelopmentConfig
 }
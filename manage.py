@@ -5,13 +5,18 @@ import logging
 import os
 
 from flask_script import Manager, Shell
-import xlrd
 
 from pma_api import create_app, db
+from pma_api.ingest import BulkLoader, WorkbookReader
+from pma_api.snapshot import export_snapshot, import_snapshot
 from pma_api.models import (Cache, Characteristic, CharacteristicGroup,
                             Country, Data, EnglishString, Geography, Indicator,
                             SourceData, Survey, Translation)
 import pma_api.api_1_0.caching as caching
+import pma_api.api_1_0.exports as exports
+import pma_api.api_1_0.warming as warming
+import pma_api.shadow as shadow
+from pma_api.utils import file_md5
 
 
 app = create_app(os.getenv('FLASK_CONFIG', 'default'))
@@ -82,50 +87,27 @@ def init_from_source(path, model):
         db.session.commit()
 
 
-def init_from_sheet(ws, model):
-    """Initialize DB table data from XLRD Worksheet.
-
-    Initialize table data from source data associated with the corresponding
-    data model.
-
-    Args:
-        ws (xlrd.sheet.Sheet): XLRD worksheet object.
-        model (class): SqlAlchemy model class.
-    """
-    header = None
-    for i, row in enumerate(ws.get_rows()):
-        row = [r.value for r in row]
-        if i == 0:
-            header = row
-        else:
-            row_dict = {k: v for k, v in zip(header, row)}
-            try:
-                record = model(**row_dict)
-            except:
-                msg = 'Error when processing row {} of "{}". Cell values: {}'
-                msg = msg.format(i+1, ws.name, row)
-                logging.error(msg)
-                raise
-            db.session.add(record)
-    db.session.commit()
-
-
-def init_from_workbook(wb, queue):
+def init_from_workbook(wb, queue, processes=None):
     """Init from workbook.
 
+    Data sheets are parsed in a pool of worker processes if more than one
+    is given.
+
     Args:
-        wb (xlrd.Workbook): Workbook object.
+        wb (str): Path to the workbook.
         queue (tuple): Order in which to load models.
+        processes (int): Number of worker processes. If None or 1, sheets are
+            parsed in this process.
     """
-    with xlrd.open_workbook(wb) as book:
+    loader = BulkLoader()
+    with WorkbookReader(wb) as book:
         for sheetname, model in queue:
             if sheetname == 'data':  # actually done last
-                for ws in book.sheets():
-                    if ws.name.startswith('data'):
-                        init_from_sheet(ws, model)
+                names = [name for name in book.sheet_names()
+                         if name.startswith('data')]
+                loader.load_sheets(model, wb, names, processes)
             else:
-                ws = book.sheet_by_name(sheetname)
-                init_from_sheet(ws, model)
+                loader.load_rows(model, sheetname, book.rows(sheetname))
     create_wb_metadata(wb)
 
 
@@ -135,28 +117,153 @@ def create_wb_metadata(wb_path):
     Args:
         wb_path (str) Path to Excel Workbook.
     """
-    record = SourceData(wb_path)
+    record = SourceData(wb_path, app.config['SOURCE_DATA_BLOB'])
     db.session.add(record)
     db.session.commit()
 
 
 @manager.option('--overwrite', help='Drop tables first?', action='store_true')
-def initdb(overwrite=False):
+@manager.option('--processes', type=int, default=None,
+                help='Number of processes parsing data sheets, default '
+                     'none.')
+def initdb(overwrite=False, processes=None):
     """Create the database.
 
     Args:
         overwrite (bool): Overwrite database if True, else update.
+        processes (int): Number of processes parsing data sheets. If None,
+            sheets are parsed in this process.
     """
     with app.app_context():
         if overwrite:
             db.drop_all()
         db.create_all()
         if overwrite:
-            init_from_workbook(wb=SRC_DATA, queue=ORDERED_MODEL_MAP)
+            init_from_workbook(wb=SRC_DATA, queue=ORDERED_MODEL_MAP,
+                               processes=processes)
             init_from_workbook(wb=UI_DATA, queue=TRANSLATION_MODEL_MAP)
             caching.cache_datalab_init(app)
 
 
+@manager.option('--processes', type=int, default=None,
+                help='Number of worker processes, default one per CPU for '
+                     'warming and none for parsing.')
+def deploy(processes=None):
+    """Load the source data into a shadow dataset and activate it.
+
+    Unlike initdb --overwrite, the live dataset keeps serving while the new
+    one is loaded and its cache warmed. The switch is then atomic, and
+    running workers use the new dataset from their next request.
+
+    Args:
+        processes (int): Number of worker processes for parsing and warming.
+            If None, sheets are parsed in this process and one warming
+            process is used per CPU.
+    """
+    config_name = os.getenv('FLASK_CONFIG', 'default')
+    live_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    shadow.prepare_shadow(live_uri)
+    shadow_app = create_app(config_name, shadow.shadow_uri(live_uri))
+    with shadow_app.app_context():
+        db.create_all()
+        init_from_workbook(wb=SRC_DATA, queue=ORDERED_MODEL_MAP,
+                           processes=processes)
+        init_from_workbook(wb=UI_DATA, queue=TRANSLATION_MODEL_MAP,
+                           processes=processes)
+        caching.cache_datalab_init(shadow_app)
+        count = warming.warm_cache(config_name, processes)
+        db.session.remove()
+        db.get_engine(shadow_app).dispose()
+    shadow.activate_shadow(live_uri)
+    logging.warning('Activated new dataset with %d cached datalab responses.',
+                    count)
+
+
+@manager.option('action', choices=('export', 'import'),
+                help='Write a snapshot of the database, or load one.')
+@manager.option('--path', help='Path to the snapshot file, by default '
+                               './data/snapshot-<API data md5>.npz.')
+def snapshot(action, path=None):
+    """Export the loaded source data to a snapshot, or import one.
+
+    Importing replaces the database, like initdb --overwrite, but without
+    parsing the workbooks. By default the snapshot of the API data workbook
+    in ./data is imported.
+
+    Args:
+        action (str): 'export' or 'import'.
+        path (str): Path to the snapshot file.
+    """
+    with app.app_context():
+        if action == 'export':
+            md5 = SourceData.get_current_api_md5()
+        else:
+            md5 = file_md5(SRC_DATA)
+        path = path or './data/snapshot-{}.npz'.format(md5)
+        if action == 'export':
+            export_snapshot(path)
+            return
+        db.drop_all()
+        db.create_all()
+        count = import_snapshot(path)
+        caching.cache_datalab_init(app)
+        logging.warning('Imported %d records from %s.', count, path)
+
+
+def reload_from_workbooks(wb, ui_wb, flask_app=None):
+    """Load new source data in place, writing only what changed.
+
+    Records are matched with the loaded ones by natural key, e.g. data by
+    survey, indicator and characteristics. Everything is written in one
+    transaction, so the API serves either the old or the new data.
+
+    Args:
+        wb (str): Path to the API data workbook.
+        ui_wb (str): Path to the UI data workbook.
+        flask_app (Flask): The app of the current app context, by default
+            the app of this module.
+    """
+    loader = BulkLoader()
+    with WorkbookReader(wb) as book, WorkbookReader(ui_wb) as ui_book:
+        for sheetname, model in ORDERED_MODEL_MAP:
+            if sheetname == 'data':
+                sheets = [(name, book.rows(name))
+                          for name in book.sheet_names()
+                          if name.startswith('data')]
+            elif model is Translation:
+                sheets = [(sheetname, book.rows(sheetname)),
+                          (sheetname, ui_book.rows(sheetname))]
+            else:
+                sheets = [(sheetname, book.rows(sheetname))]
+            counts = loader.reload_rows(model, sheets)
+            logging.warning('%s: %d inserted, %d updated, %d removed.',
+                            model.__tablename__, *counts)
+    count = loader.delete_removed()
+    logging.warning('english_string: %d removed.', count)
+    db.session.query(SourceData).delete()
+    for path in (wb, ui_wb):
+        db.session.add(SourceData(path, app.config['SOURCE_DATA_BLOB']))
+    db.session.commit()
+    caching.cache_datalab_init(flask_app or app)
+
+
+@manager.option('--src', help='Path to the API data workbook.')
+@manager.option('--ui-src', help='Path to the UI data workbook.')
+def reload(src=None, ui_src=None):
+    """Load new source data in place, writing only what changed.
+
+    See reload_from_workbooks.
+
+    Args:
+        src (str): Path to the API data workbook, by default the one in
+            ./data.
+        ui_src (str): Path to the UI data workbook, by default the one in
+            ./data.
+    """
+    with app.app_context():
+        reload_from_workbooks(src or SRC_DATA, ui_src or UI_DATA)
+
+
 @manager.command
 def translations():
     """Import anew all translations into the database."""
@@ -169,11 +276,69 @@ def translations():
         init_from_workbook(wb=UI_DATA, queue=TRANSLATION_MODEL_MAP)
 
 
-@manager.command
-def cache_responses():
-    """Cache responses in the 'cache' table of DB."""
+@manager.option('--recreate', help='Drop and create the cache table first?',
+                action='store_true')
+def cache_responses(recreate=False):
+    """Cache responses in the 'cache' table of DB.
+
+    Args:
+        recreate (bool): Drop and create the cache table first if True, e.g.
+            after its columns have changed.
+    """
+    with app.app_context():
+        if recreate:
+            Cache.__table__.drop(db.engine, checkfirst=True)
+            Cache.__table__.create(db.engine)
+        caching.cache_datalab_init(app)
+
+
+@manager.option('--processes', type=int, default=None,
+                help='Number of worker processes, default one per CPU.')
+def warm_cache(processes=None):
+    """Cache datalab responses for every valid selection.
+
+    Args:
+        processes (int): Number of worker processes, one per CPU if None.
+    """
     with app.app_context():
         caching.cache_datalab_init(app)
+        count = warming.warm_cache(os.getenv('FLASK_CONFIG', 'default'),
+                                   processes)
+        logging.warning('Cached %d datalab responses.', count)
+
+
+@manager.command
+def build_exports():
+    """Write the full dataset export files of the current source data."""
+    with app.app_context():
+        paths = exports.build_exports()
+        logging.warning('Built %d export files in %s.', len(paths),
+                        app.config['EXPORTS_DIR'])
+
+
+@manager.option('--top', type=int, default=10,
+                help='Number of records to list by most and fewest hits.')
+def cache_stats(top=10):
+    """Report on the size and use of the 'cache' table.
+
+    Args:
+        top (int): Number of records to list by most and fewest hits.
+    """
+    with app.app_context():
+        Cache.flush_hits()
+        stats = Cache.stats(SourceData.get_current_api_md5(), top)
+        budget = app.config['CACHE_MAX_BYTES']
+        print('Budget: {} bytes, {} eviction'.format(
+            budget, app.config['CACHE_EVICTION_POLICY']))
+        for name in ('all', 'stale', 'never_hit'):
+            summary = stats[name]
+            print('{:10} {:>8} records {:>12} bytes {:>10} hits'.format(
+                name, summary['records'], summary['bytes'], summary['hits']))
+        for name in ('most_hit', 'least_hit'):
+            print('{}:'.format(name))
+            for key, hits, size, last_accessed in stats[name]:
+                print('{:>10} hits {:>10} bytes  {:%Y-%m-%d %H:%M}  {}'.format(
+                    hits, size, last_accessed, key))
 
 
 manager.add_command('shell', Shell(make_context=make_shell_context))
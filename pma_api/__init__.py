@@ -1,5 +1,5 @@
 """Definition of application object."""
-from flask import Blueprint, jsonify
+from flask import Blueprint
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 
@@ -11,7 +11,10 @@ db = SQLAlchemy()
 
 # pylint: disable=wrong-import-position
 from .app import PmaApiFlask
-from .response import QuerySetApiResult
+from .models import SourceData
+from .encoders import get_encoder
+from .response import QuerySetApiResult, encode_json
+from .utils import LruCache, TimedMemo
 
 
 root = Blueprint('root', __name__)
@@ -20,20 +23,29 @@ root = Blueprint('root', __name__)
 @root.route('/version')
 def show_version():
     """Show API version data."""
-    return jsonify(QuerySetApiResult.metadata())
+    return encode_json(QuerySetApiResult.metadata())
 
 
-def create_app(config_name):
+def create_app(config_name, database_uri=None):
     """Create configured Flask application.
 
     Args:
         config_name (str): Name of the configuration to be used.
+        database_uri (str): SqlAlchemy URI of the database to use instead of
+            the configured one, e.g. a shadow dataset.
 
     Returns:
         Flask: Configured Flask application.
     """
     app = PmaApiFlask(__name__)
     app.config.from_object(config[config_name])
+    if database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.json_backend = get_encoder(app.config['JSON_ENCODER'])
+    app.local_cache = LruCache(app.config['CACHE_LOCAL_MAX_BYTES'],
+                               app.config['CACHE_LOCAL_TTL'])
+    app.source_data_freshness = TimedMemo(SourceData.query_freshness,
+                                          app.config['SOURCE_DATA_TTL'])
 
     CORS(app)
     db.init_app(app)
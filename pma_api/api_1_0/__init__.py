@@ -6,7 +6,7 @@ from ..queries import DatalabData
 api = Blueprint('api', __name__)
 
 # pylint: disable=wrong-import-position
-from . import collection, datalab
+from . import caching, collection, datalab, exports
 from ..response import QuerySetApiResult
 
 
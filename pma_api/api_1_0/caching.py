@@ -1,39 +1,318 @@
 """Caching."""
-from flask import url_for
+from datetime import datetime
+from functools import wraps
+from hashlib import md5
+from urllib.parse import urlencode
 
+from flask import Response, current_app, request, url_for
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
+
+from . import api
 from .. import db
+from ..__version__ import __version__
 from ..models import Cache, SourceData
+from ..utils import SingleFlight, Throttle, request_memo
+
+
+# Cached as requested by the datalab, with compact JSON, see cache_key.
+KEY_DATALAB_INIT = 'v1/datalab/init#xhr'
+
+# Query arguments that hold comma separated lists, where order and duplicates
+# do not change the result.
+LIST_ARGS = ('survey',)
+# Query arguments that are booleans, true if any case variant of 'true'. They
+# default to false, so false values are left out.
+BOOLEAN_ARGS = ('overTime',)
+# Query arguments that only control caching itself.
+IGNORED_ARGS = ('cached',)
+# Endpoints whose responses change without the source data, e.g. files built
+# later. Their views set their own validators, so check_not_modified skips
+# them.
+UNVERSIONED_ENDPOINTS = ('api.get_exports', 'api.get_export')
+# Content codings that Cache.to_response may apply. The entity tag of an
+# encoded response gets the coding as a suffix, so that it stays strong.
+ETAG_ENCODINGS = ('gzip', 'br')
+
+# Cache misses being filled by this process, by cache key.
+_FLIGHTS = SingleFlight()
+# Trims of the cache table after saves by this process.
+_TRIMS = Throttle()
+
+
+def canonical_args(args):
+    """Put query arguments into a canonical form.
+
+    Args:
+        args (MultiDict): Query arguments of a request.
+
+    Returns:
+        list: Sorted (key, value) pairs of the arguments that affect the
+        response.
+    """
+    result = []
+    for key, value in args.items():
+        if key in IGNORED_ARGS:
+            continue
+        if key in LIST_ARGS:
+            value = ','.join(sorted(set(value.split(','))))
+        elif key in BOOLEAN_ARGS:
+            if value.lower() != 'true':
+                continue
+            value = 'true'
+        result.append((key, value))
+    return sorted(result)
+
+
+def cache_key(path, args, is_xhr=False):
+    """Build the cache key of a request.
+
+    JSON is compact for requests with X-Requested-With, and pretty printed
+    otherwise, so the keys of such requests get the suffix '#xhr', which no
+    request URL can contain.
+
+    Args:
+        path (str): The URL path of the request, e.g. '/v1/datalab/data'.
+        args (MultiDict): Query arguments of the request.
+        is_xhr (bool): Whether the request has X-Requested-With.
+
+    Returns:
+        str: The key, e.g. 'v1/datalab/data?indicator=mcpr_aw#xhr'.
+    """
+    key = path.lstrip('/')
+    query = urlencode(canonical_args(args), safe=',')
+    if query:
+        key = '?'.join((key, query))
+    if is_xhr:
+        key += '#xhr'
+    return key
+
+
+def response_etag():
+    """Return the entity tag of the response to the current request.
+
+    The tag is derived from the version of the API, the versions of the
+    loaded source data, the path, the canonical query arguments, and whether
+    the JSON is pretty printed.
+
+    Returns:
+        str: The tag, without quotes or content coding suffix.
+    """
+    def build_etag():
+        """Hash everything the response depends on."""
+        version, _ = current_app.source_data_freshness.get()
+        parts = (__version__, version, request.path,
+                 canonical_args(request.args), request.is_xhr)
+        return md5(repr(parts).encode('utf-8')).hexdigest()
+    return request_memo('etag', build_etag)
+
+
+@api.before_request
+def check_not_modified():
+    """Answer a conditional GET with 304 if the client's entity tag is current.
+
+    This runs before the view, so no query is made other than for the source
+    data versions, and that at most once per SOURCE_DATA_TTL seconds. Only a
+    tag that was sent with a successful response is matched here. Other
+    validators, i.e. If-Modified-Since and 'If-None-Match: *', are checked by
+    add_cache_headers once the view has succeeded.
+
+    Returns:
+        Response: An empty 304 response, or None to continue with the view.
+    """
+    if request.method not in ('GET', 'HEAD') or not request.if_none_match or \
+            request.if_none_match.star_tag or \
+            request.endpoint in UNVERSIONED_ENDPOINTS:
+        return None
+    etag = response_etag()
+    tags = [etag] + ['{}-{}'.format(etag, encoding)
+                     for encoding in ETAG_ENCODINGS]
+    matched = [tag for tag in tags if request.if_none_match.contains(tag)]
+    if not matched:
+        return None
+    response = Response(status=304)
+    response.set_etag(matched[0])
+    response.vary.add('X-Requested-With')
+    return response
+
+
+@api.after_request
+def add_cache_headers(response):
+    """Add validators and Cache-Control to successful GET responses.
+
+    A successful response is replaced by 304 if the client's validators
+    match it. The body depends on X-Requested-With, which sets whether JSON
+    is pretty printed, so that header is added to Vary.
 
+    Args:
+        response (Response): The response of the view.
+
+    Returns:
+        Response: The same response.
+    """
+    if request.method not in ('GET', 'HEAD') or \
+            response.status_code not in (200, 304):
+        return response
+    if response.get_etag()[0] is None:
+        etag = response_etag()
+        encoding = response.headers.get('Content-Encoding')
+        if encoding:
+            etag = '{}-{}'.format(etag, encoding)
+        response.set_etag(etag)
+    _, modified = current_app.source_data_freshness.get()
+    if modified and response.last_modified is None:
+        response.last_modified = modified
+    response.vary.add('X-Requested-With')
+    max_age = current_app.config['CACHE_CONTROL_MAX_AGE']
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if response.status_code == 200 and not is_resource_modified(
+            request.environ, response.get_etag()[0],
+            last_modified=response.last_modified):
+        response.status_code = 304
+    return response
+
+
+def save_response(key, response, source_data_md5):
+    """Save a response in the cache.
+
+    If another worker saves the same key at the same time, its record is
+    kept. The cache table is trimmed at most once per CACHE_TRIM_SECONDS by
+    each process.
+
+    Args:
+        key (str): The cache key.
+        response (Response): The response to save.
+        source_data_md5 (str): The md5 of the data used for the response.
+
+    Returns:
+        Cache: A copy of the saved record that belongs to no session, or None
+        if the record of another worker was kept.
+    """
+    current_cache = Cache.get(key)
+    if current_cache is None:
+        current_cache = Cache(key=key)
+        db.session.add(current_cache)
+    current_cache.compress(response.get_data())
+    current_cache.mimetype = response.mimetype
+    current_cache.source_data_md5 = source_data_md5
+    current_cache.last_accessed = datetime.utcnow()
+    local_copy = current_cache.detached_copy()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    local_copy.keep_local()
+    if _TRIMS.due(current_app.config['CACHE_TRIM_SECONDS']):
+        trim_cache(source_data_md5)
+    return local_copy
+
+
+def trim_cache(source_data_md5):
+    """Remove stale records and keep the cache table within its budget.
+
+    Args:
+        source_data_md5 (str): The md5 of the current source data.
+
+    Returns:
+        int: Number of records removed.
+    """
+    config = current_app.config
+    return Cache.trim(source_data_md5, config['CACHE_MAX_BYTES'],
+                      config['CACHE_EVICTION_POLICY'])
 
-KEY_DATALAB_INIT = 'v1/datalab/init'
+
+def lock_key(key):
+    """Wait until no other worker is filling the cache for a key.
+
+    On PostgreSQL this takes a transaction level advisory lock, which is
+    released when the current transaction ends, e.g. when the response is
+    saved. Other databases are not locked.
+
+    Args:
+        key (str): The cache key.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    digest = md5(key.encode('utf-8')).digest()
+    lock_id = int.from_bytes(digest[:8], 'big', signed=True)
+    db.session.execute('SELECT pg_advisory_xact_lock(:lock_id)',
+                       {'lock_id': lock_id})
+
+
+def cached_response(view):
+    """Decorate a view so that its responses are cached.
+
+    The cache key is the request path with canonical query arguments, and
+    whether JSON is compact, see cache_key. A cached response is used only
+    if it was made from the current source data. Query argument
+    'cached=false' bypasses the cache.
+
+    On a miss, only one request computes the response. Identical requests in
+    the same process wait for it, and requests in other workers wait on a
+    database lock and then find it in the cache.
+
+    Args:
+        view (callable): A view function for GET requests.
+
+    Returns:
+        callable: The decorated view function.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        """Return the cached response, or make and cache a new one."""
+        if request.args.get('cached') == 'false':
+            return view(*args, **kwargs)
+        key = cache_key(request.path, request.args, request.is_xhr)
+        source_data_md5 = SourceData.get_current_api_md5()
+        current_cache = Cache.lookup(key, source_data_md5)
+        if current_cache:
+            return current_cache
+        made = []
+
+        def fill():
+            """Make and save the response unless another worker did."""
+            lock_key(key)
+            record = Cache.lookup(key, source_data_md5)
+            if record is None:
+                response = current_app.make_response(view(*args, **kwargs))
+                made.append(response)
+                if response.status_code == 200:
+                    record = save_response(key, response, source_data_md5)
+            return record
+        current_cache = _FLIGHTS.run(key, fill)
+        if made:
+            return made[0]
+        if current_cache is None:
+            return view(*args, **kwargs)
+        return current_cache
+    return wrapper
 
 
 def cache_datalab_init(app):
     """Add /v1/datalab/init to the server cache.
 
     This method checks the cache. If there is nothing cached or if the md5s do
-    not match, then a new cached response is generated and saved.
+    not match, then a new cached response is generated and saved. Like any
+    cache miss, this is done only once at a time across workers.
 
     Args:
         app (Flask): The Flask app. There must be a current app context.
     """
-    source_data_md5 = SourceData.get_current_api_data().md5_checksum
-    current_cache = Cache.get(KEY_DATALAB_INIT)
-    if not current_cache or current_cache.source_data_md5 != source_data_md5:
-        url = url_for('api.get_datalab_init')
+    source_data_md5 = SourceData.get_current_api_md5()
+
+    def fill():
+        """Make and save the response unless it is up to date."""
+        lock_key(KEY_DATALAB_INIT)
+        current_cache = Cache.get(KEY_DATALAB_INIT)
+        if current_cache and current_cache.source_data_md5 == source_data_md5:
+            return current_cache.detached_copy()
+        with app.test_request_context():
+            url = url_for('api.get_datalab_init', cached='false')
         headers = {'X-Requested-With': 'XMLHttpRequest'}
         with app.test_request_context(url, headers=headers):
-            api_result = app.view_functions['api.get_datalab_init']()
-            response = api_result.to_response()
-            value = response.get_data(as_text=True).strip()
-            mimetype = response.mimetype
-            if current_cache:
-                current_cache.value = value
-                current_cache.mimetype = mimetype
-                current_cache.source_data_md5 = source_data_md5
-            else:
-                new_cache = Cache(key=KEY_DATALAB_INIT, value=value,
-                                  mimetype=mimetype,
-                                  source_data_md5=source_data_md5)
-                db.session.add(new_cache)
-            db.session.commit()
+            response = app.make_response(
+                app.view_functions['api.get_datalab_init']())
+            return save_response(KEY_DATALAB_INIT, response, source_data_md5)
+    _FLIGHTS.run(KEY_DATALAB_INIT, fill)
@@ -1,11 +1,125 @@
 """Routes for API collections."""
-from flask import request, url_for
+from functools import partial
+
+from flask import abort, current_app, request, url_for
 
 from . import api
-from ..response import QuerySetApiResult
+from .. import db
+from ..response import QuerySetApiResult, StreamingApiResult
 from ..models import Country, EnglishString, Survey, Indicator, Data
 
 
+# Records fetched per round trip when streaming a collection.
+STREAM_CHUNK_SIZE = 1000
+
+
+def paginate(query, model):
+    """Get one page of a query, as selected by the request.
+
+    Pages are in id order. Query argument 'limit' sets the page size, at
+    most PAGE_SIZE_MAX, and 'after' the id after which the page starts. Both
+    must be positive integers, or the request is answered with 400.
+
+    Args:
+        query (Query): The query for all records.
+        model (class): SqlAlchemy model class of the records.
+
+    Returns:
+        tuple: The records of the page, and metadata with a link to the next
+        page if there is one.
+    """
+    page_size_max = current_app.config['PAGE_SIZE_MAX']
+    limit = min(positive_int_arg('limit', page_size_max), page_size_max)
+    after = positive_int_arg('after')
+    if after is not None:
+        query = query.filter(model.id > after)
+    records = query.order_by(model.id).limit(limit + 1).all()
+    metadata = {}
+    if len(records) > limit:
+        records = records[:limit]
+        args = request.args.to_dict()
+        args.update(limit=limit, after=records[-1].id)
+        metadata['next'] = url_for(request.endpoint, _external=True, **args)
+    return records, metadata
+
+
+def positive_int_arg(name, default=None):
+    """Get a query argument that must be a positive integer.
+
+    Args:
+        name (str): Name of the query argument.
+        default (int): Value if the argument is missing.
+
+    Returns:
+        int: The value of the argument, or the default.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        msg = 'Query argument "{}" must be a positive integer, not "{}".'
+        abort(400, msg.format(name, value))
+    return number
+
+
+def stream_records(query, model, serialize):
+    """Serialize all records of a query while they are fetched.
+
+    The query is read in chunks, with a server-side cursor on PostgreSQL,
+    and the session is emptied after each chunk, so that memory use does
+    not grow with the number of records.
+
+    Args:
+        query (Query): The query for all records.
+        model (class): SqlAlchemy model class of the records.
+        serialize (callable): Converts a record to a dict.
+
+    Yields:
+        dict: Each serialized record, in id order.
+    """
+    records = query.order_by(model.id).yield_per(STREAM_CHUNK_SIZE)
+    for i, record in enumerate(records, start=1):
+        yield serialize(record)
+        if i % STREAM_CHUNK_SIZE == 0:
+            db.session.expunge_all()
+
+
+def collection_response(query, model, serialize):
+    """Respond with a page of records, or stream all of them.
+
+    With query argument 'stream=true', every record is streamed, as 'json',
+    'ndjson' or 'csv' depending on query argument 'format'. Otherwise one
+    page is returned as JSON, see paginate. Other formats are answered with
+    400.
+
+    Args:
+        query (Query): The query for all records.
+        model (class): SqlAlchemy model class of the records.
+        serialize (callable): Converts a record to a dict.
+
+    Returns:
+        ApiResult: The result to return from the view.
+    """
+    stream = request.args.get('stream', 'false').lower() == 'true'
+    return_format = request.args.get('format', 'json')
+    formats = StreamingApiResult.mimetypes if stream else ('json',)
+    if return_format not in formats:
+        msg = 'Format "{}" is not supported{}. Supported: {}.'
+        abort(400, msg.format(return_format,
+                              '' if stream else ' without stream=true',
+                              ', '.join(sorted(formats))))
+    if stream:
+        return StreamingApiResult(stream_records(query, model, serialize),
+                                  return_format)
+    records, metadata = paginate(query, model)
+    data = [serialize(record) for record in records]
+    return QuerySetApiResult(data, 'json', metadata)
+
+
 @api.route('/countries')
 def get_countries():
     """Country resource collection GET method.
@@ -13,9 +127,8 @@ def get_countries():
     Returns:
         json: Collection for resource.
     """
-    countries = Country.query.all()
-    data = [c.full_json() for c in countries]
-    return QuerySetApiResult(data, 'json')
+    query = Country.query.options(*Country.full_json_loaders())
+    return collection_response(query, Country, Country.full_json)
 
 
 @api.route('/countries/<code>')
@@ -43,9 +156,8 @@ def get_surveys():
     """
     # Query by year, country, round
     # print(request.args)
-    surveys = Survey.query.all()
-    data = [s.full_json() for s in surveys]
-    return QuerySetApiResult(data, 'json')
+    query = Survey.query.options(*Survey.full_json_loaders())
+    return collection_response(query, Survey, Survey.full_json)
 
 
 @api.route('/surveys/<code>')
@@ -58,7 +170,8 @@ def get_survey(code):
     Returns:
         json: Entity of resource.
     """
-    survey = Survey.query.filter_by(code=code).first()
+    survey = Survey.query.options(*Survey.full_json_loaders())\
+        .filter_by(code=code).first()
     json_obj = survey.full_json()
     return QuerySetApiResult(json_obj, 'json')
 
@@ -70,9 +183,10 @@ def get_indicators():
     Returns:
         json: Collection for resource.
     """
-    indicators = Indicator.query.all()
-    data = [i.full_json(endpoint='api.get_indicator') for i in indicators]
-    return QuerySetApiResult(data, 'json')
+    query = Indicator.query.options(*Indicator.full_json_loaders())
+    return collection_response(
+        query, Indicator,
+        partial(Indicator.full_json, endpoint='api.get_indicator'))
 
 
 @api.route('/indicators/<code>')
@@ -85,7 +199,8 @@ def get_indicator(code):
     Returns:
         json: Entity of resource.
     """
-    indicator = Indicator.query.filter_by(code=code).first()
+    indicator = Indicator.query.options(*Indicator.full_json_loaders())\
+        .filter_by(code=code).first()
     json_obj = indicator.full_json()
     return QuerySetApiResult(json_obj, 'json')
 
@@ -97,9 +212,8 @@ def get_data():
     Returns:
         json: Collection for resource.
     """
-    all_data = data_refined_query(request.args)
-    data = [d.full_json() for d in all_data]
-    return QuerySetApiResult(data, 'json')
+    return collection_response(data_refined_query(request.args), Data,
+                               Data.full_json)
 
 
 def data_refined_query(args):
@@ -109,13 +223,12 @@ def data_refined_query(args):
         survey (str): If present, filter by survey entities.
 
     Returns:
-        dict: Filtered query data.
+        Query: Filtered data query.
     """
-    qset = Data.query
+    qset = Data.query.options(*Data.full_json_loaders())
     if 'survey' in args:
         qset = qset.filter(Data.survey.has(code=args['survey']))
-    results = qset.all()
-    return results
+    return qset
 
 
 @api.route('/data/<code>')
@@ -128,7 +241,8 @@ def get_datum(code):
     Returns:
         json: Entity of resource.
     """
-    data = Data.query.filter_by(code=code).first()
+    data = Data.query.options(*Data.full_json_loaders())\
+        .filter_by(code=code).first()
     json_obj = data.full_json()
     return QuerySetApiResult(json_obj, 'json')
 
@@ -140,9 +254,8 @@ def get_texts():
     Returns:
         json: Collection for resource.
     """
-    english_strings = EnglishString.query.all()
-    data = [d.to_json() for d in english_strings]
-    return QuerySetApiResult(data, 'json')
+    return collection_response(EnglishString.query, EnglishString,
+                               EnglishString.to_json)
 
 
 @api.route('/texts/<code>')
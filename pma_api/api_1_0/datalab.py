@@ -2,8 +2,7 @@
 from flask import request
 
 from . import api
-from . import caching
-from ..models import Cache
+from .caching import cached_response, canonical_args
 from ..response import ApiResult, QuerySetApiResult
 from ..queries import DatalabData
 
@@ -12,6 +11,7 @@ DEFAULT_PRECISION = 1
 
 
 @api.route('/datalab/data')
+@cached_response
 def get_datalab_data():
     """Get the correct slice of datalab data."""
     survey = request.args.get('survey', None)
@@ -30,8 +30,8 @@ def get_datalab_data():
     precisions = list(x['precision'] for x in json_list if x['precision'] is
                       not None)
     min_precision = min(precisions) if precisions else DEFAULT_PRECISION
-    for item in json_list:
-        item['value'] = round(item['value'], min_precision)
+    json_list = [dict(item, value=round(item['value'], min_precision))
+                 for item in json_list]
     if over_time:
         json_obj = DatalabData.data_to_time_series(json_list)
     else:
@@ -43,6 +43,7 @@ def get_datalab_data():
 
 
 @api.route('/datalab/combos')
+@cached_response
 def get_datalab_combos():
     """Get datalab combos."""
     survey_s = request.args.get('survey', '')
@@ -52,16 +53,16 @@ def get_datalab_combos():
     char_grp_s = request.args.get('characteristicGroup', '')
     char_grp = char_grp_s if char_grp_s else None
     json_obj = DatalabData.combos_all(survey_list, indicator, char_grp)
-    request_params = request.args.to_dict()
+    # Echo canonical parameters, since the response is shared by all
+    # equivalent queries through the cache.
+    request_params = dict(canonical_args(request.args))
     metadata = {'queryParameters': request_params}
     return ApiResult(json_obj, metadata=metadata)
 
 
 @api.route('/datalab/init')
+@cached_response
 def get_datalab_init():
     """Get datalab combos."""
-    cached = Cache.get(caching.KEY_DATALAB_INIT)
-    if cached and not request.args.get('cached') == 'false':
-        return cached
     json_obj = DatalabData.datalab_init()
     return ApiResult(json_obj)
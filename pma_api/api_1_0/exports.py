@@ -0,0 +1,172 @@
+"""Full dataset export files.
+
+Downloading all data through /v1/data repeats the whole join and
+serialization for every request. Instead, every data record, with the same
+fields as /v1/data returns, is written once per source data md5 to gzipped
+files, one per language and format. They are served as static files that
+support Range requests, so that interrupted downloads can be resumed.
+"""
+import csv
+import gzip
+import os
+import shutil
+from datetime import datetime
+from functools import partial
+from hashlib import md5
+
+from flask import abort, current_app, json, send_file, url_for
+
+from . import api
+from .caching import response_etag
+from .collection import stream_records
+from ..models import Data, SourceData, Translation
+from ..response import QuerySetApiResult
+from ..utils import memo_scope
+
+
+# Formats of export files.
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+def export_directory(source_data_md5):
+    """Return the directory of the export files of some source data.
+
+    Args:
+        source_data_md5 (str): The md5 of the source data, or None.
+
+    Returns:
+        str: Path to the directory, or None if no source data is loaded.
+    """
+    if source_data_md5 is None:
+        return None
+    return os.path.join(current_app.config['EXPORTS_DIR'], source_data_md5)
+
+
+def export_files():
+    """List the export files of any source data.
+
+    Returns:
+        list of tuple: File name, language and format of each file.
+    """
+    return [('pma-data-{}.{}.gz'.format(lang, export_format), lang,
+             export_format)
+            for lang in sorted(Translation.languages())
+            for export_format in EXPORT_FORMATS]
+
+
+def write_export(path, records, export_format):
+    """Write records to a gzipped export file.
+
+    The file is written under a temporary name and then renamed, so that
+    it is never served partly written.
+
+    Args:
+        path (str): Path to the file.
+        records (iterable of dict): The records.
+        export_format (str): 'csv' or 'ndjson'.
+    """
+    partial_path = path + '.partial'
+    with gzip.open(partial_path, 'wt', encoding='utf-8', newline='') as file:
+        writer = None
+        for record in records:
+            if export_format == 'ndjson':
+                file.write(json.dumps(record) + '\n')
+                continue
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=record.keys())
+                writer.writeheader()
+            writer.writerow(record)
+    os.replace(partial_path, path)
+
+
+def build_exports():
+    """Write the export files of the current source data.
+
+    Each file has every data record, as serialized by Data.full_json. Files
+    of other source data are removed. There must be a current app context.
+    The source data version is queried once for all files.
+
+    Returns:
+        list of str: Paths to the files written.
+    """
+    source_data_md5 = SourceData.get_current_api_md5()
+    if source_data_md5 is None:
+        return []
+    root = current_app.config['EXPORTS_DIR']
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name != source_data_md5 and os.path.isdir(path):
+                shutil.rmtree(path)
+    directory = export_directory(source_data_md5)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    query = Data.query.options(*Data.full_json_loaders())
+    with memo_scope():
+        for filename, lang, export_format in export_files():
+            path = os.path.join(directory, filename)
+            records = stream_records(query, Data,
+                                     partial(Data.full_json, lang=lang))
+            write_export(path, records, export_format)
+            paths.append(path)
+    return paths
+
+
+@api.route('/exports')
+def get_exports():
+    """Get the export files of the current source data.
+
+    Files may be built after the source data is loaded, so the validators
+    of the response also depend on the size and time of each file.
+
+    Returns:
+        json: Language, format, size and URL of each file.
+    """
+    directory = export_directory(SourceData.get_current_api_md5())
+    data = []
+    stats = []
+    for filename, lang, export_format in export_files():
+        if directory is None:
+            break
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stats.append((filename, stat.st_size, stat.st_mtime))
+            data.append({
+                'language': lang,
+                'format': export_format,
+                'size': stat.st_size,
+                'url': url_for('api.get_export', filename=filename,
+                               _external=True)
+            })
+    response = current_app.make_response(QuerySetApiResult(data, 'json'))
+    parts = (response_etag(), stats)
+    response.set_etag(md5(repr(parts).encode('utf-8')).hexdigest())
+    times = [datetime.utcfromtimestamp(mtime) for _, _, mtime in stats]
+    _, modified = current_app.source_data_freshness.get()
+    if modified:
+        times.append(modified)
+    if times:
+        response.last_modified = max(times)
+    return response
+
+
+@api.route('/exports/<filename>')
+def get_export(filename):
+    """Get an export file of the current source data.
+
+    Args:
+        filename (str): Name of the file, as listed by /v1/exports.
+
+    Returns:
+        file: The gzipped file. Range requests are supported.
+    """
+    directory = export_directory(SourceData.get_current_api_md5())
+    if directory is None or \
+            filename not in (name for name, _, _ in export_files()):
+        abort(404)
+    path = os.path.join(directory, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     conditional=True)
@@ -0,0 +1,207 @@
+"""Precompute cached responses for every valid datalab selection.
+
+After new source data is loaded every cached response is stale, so the first
+visitors would wait for cold queries. Warming renders the datalab data and
+combos responses for all valid selections ahead of time, in a pool of worker
+processes, and writes them to the cache table in bulk.
+"""
+from multiprocessing import Pool
+
+from flask import current_app, url_for
+
+from .caching import cache_key, trim_cache
+from .. import db
+from ..facets import FacetIndex
+from ..models import Cache, Country, SourceData, Survey
+
+
+# Rows written to the cache table per statement.
+WRITE_CHUNK_SIZE = 500
+
+_WORKER_APP = None
+
+
+def survey_sets(facets):
+    """List the survey selections to warm.
+
+    Args:
+        facets (FacetIndex): The facet index of the current source data.
+
+    Returns:
+        list of list of str: Every single survey, and all surveys of each
+        country that has more than one.
+    """
+    result = [[code] for code in sorted(facets.surveys)]
+    by_country = {}
+    query = db.session.query(Survey.code, Country.code)\
+        .join(Country, Survey.country_id == Country.id)
+    for survey_code, country_code in query:
+        if survey_code in facets.surveys:
+            by_country.setdefault(country_code, []).append(survey_code)
+    for country_code in sorted(by_country):
+        codes = sorted(by_country[country_code])
+        if len(codes) > 1:
+            result.append(codes)
+    return result
+
+
+def warm_requests():
+    """List the datalab requests to warm.
+
+    For each survey set, these are the combos for every partial selection
+    and the data, both as series and over time, for every valid indicator and
+    characteristic group pair. Combos are also warmed without surveys.
+
+    Returns:
+        list of tuple: (endpoint, query arguments) pairs.
+    """
+    facets = FacetIndex.current()
+    result = []
+    for surveys in [None] + survey_sets(facets):
+        survey_args = {'survey': ','.join(surveys)} if surveys else {}
+        indicator_dict, char_grp_dict = facets.co_occurring(surveys)
+        result.append(('api.get_datalab_combos', survey_args))
+        for indicator in sorted(indicator_dict):
+            result.append(('api.get_datalab_combos',
+                           dict(survey_args, indicator=indicator)))
+        for char_grp in sorted(char_grp_dict):
+            result.append(('api.get_datalab_combos',
+                           dict(survey_args, characteristicGroup=char_grp)))
+        for indicator in sorted(indicator_dict):
+            for char_grp in indicator_dict[indicator]:
+                args = dict(survey_args, indicator=indicator,
+                            characteristicGroup=char_grp)
+                result.append(('api.get_datalab_combos', args))
+                if not surveys:
+                    continue
+                for over_time in ('false', 'true'):
+                    result.append(('api.get_datalab_data',
+                                   dict(args, overTime=over_time)))
+    return result
+
+
+def render_entry(app, endpoint, args, source_data_md5):
+    """Render one response as a row of the cache table.
+
+    Args:
+        app (Flask): The Flask app.
+        endpoint (str): The endpoint of the view, e.g. 'api.get_datalab_data'.
+        args (dict): Query arguments of the request.
+        source_data_md5 (str): The md5 of the current source data.
+
+    Returns:
+        dict: Column values for the cache table, or None if the response was
+        not successful.
+    """
+    with app.test_request_context():
+        url = url_for(endpoint, cached='false', **args)
+    headers = {'X-Requested-With': 'XMLHttpRequest'}
+    with app.test_request_context(url, headers=headers) as context:
+        response = app.make_response(app.view_functions[endpoint]())
+        if response.status_code != 200:
+            return None
+        record = Cache(key=cache_key(context.request.path,
+                                     context.request.args,
+                                     context.request.is_xhr),
+                       mimetype=response.mimetype,
+                       source_data_md5=source_data_md5)
+        record.compress(response.get_data())
+    return {
+        'key': record.key,
+        'value_gzip': record.value_gzip,
+        'value_brotli': record.value_brotli,
+        'mimetype': record.mimetype,
+        'source_data_md5': record.source_data_md5,
+        'size': record.size
+    }
+
+
+def init_worker(config_name, database_uri):
+    """Create the Flask app of a worker process.
+
+    Args:
+        config_name (str): Name of the configuration to be used.
+        database_uri (str): SqlAlchemy URI of the database to warm.
+    """
+    from .. import create_app
+    global _WORKER_APP  # pylint: disable=global-statement
+    _WORKER_APP = create_app(config_name, database_uri)
+    _WORKER_APP.app_context().push()
+
+
+def render_in_worker(task):
+    """Call render_entry in a worker process.
+
+    Args:
+        task (tuple): Endpoint, query arguments and md5.
+
+    Returns:
+        dict: As returned by render_entry.
+    """
+    return render_entry(_WORKER_APP, *task)
+
+
+def write_entries(rows):
+    """Replace cache table rows in bulk.
+
+    Args:
+        rows (list of dict): Column values, as returned by render_entry.
+    """
+    keys = [row['key'] for row in rows]
+    Cache.query.filter(Cache.key.in_(keys))\
+        .delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(Cache, rows)
+
+
+def warm_cache(config_name, processes=None):
+    """Render and cache every datalab request returned by warm_requests.
+
+    There must be a current app context, and workers use its database. Rows
+    are written in one transaction, so the cache is never partly warmed.
+    Stale rows are removed afterwards, and the cache table is trimmed to its
+    budget.
+
+    Args:
+        config_name (str): Name of the configuration, used to create the app
+            of each worker process.
+        processes (int): Number of worker processes. If 1, responses are
+            rendered in this process. If None, one per CPU.
+
+    Returns:
+        int: Number of responses cached.
+    """
+    source_data_md5 = SourceData.get_current_api_md5()
+    tasks = [(endpoint, args, source_data_md5)
+             for endpoint, args in warm_requests()]
+    if processes == 1:
+        # pylint: disable=protected-access
+        app = current_app._get_current_object()
+        rendered = (render_entry(app, *task) for task in tasks)
+        pool = None
+    else:
+        database_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+        pool = Pool(processes, initializer=init_worker,
+                    initargs=(config_name, database_uri))
+        rendered = pool.imap_unordered(render_in_worker, tasks, chunksize=16)
+    count = 0
+    rows = []
+    try:
+        for row in rendered:
+            if row is None:
+                continue
+            rows.append(row)
+            if len(rows) == WRITE_CHUNK_SIZE:
+                write_entries(rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            write_entries(rows)
+            count += len(rows)
+        db.session.commit()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    trim_cache(source_data_md5)
+    current_app.local_cache.clear()
+    return count
@@ -1,5 +1,5 @@
 """Custom subclass for the PMA API."""
-from flask import Flask, Response
+from flask import Flask
 
 from .models import Cache
 from .response import ApiResult
@@ -13,5 +13,5 @@ class PmaApiFlask(Flask):
         if isinstance(rv, ApiResult):
             return rv.to_response()
         elif isinstance(rv, Cache):
-            return Response(rv.value, mimetype=rv.mimetype)
+            return rv.to_response()
         return Flask.make_response(self, rv)
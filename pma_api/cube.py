@@ -0,0 +1,284 @@
+"""In-memory columnar cube of datalab data.
+
+The datalab data only changes when new source data is imported, so instead of
+running the full datalab join for every request, the facts are loaded once per
+source data md5 into NumPy column arrays. Dimensions (survey, indicator,
+characteristic, etc.) are integer coded, and filtering and ordering are done
+with masks and sorts over those arrays.
+
+NumPy is an optional dependency. If it is not installed, or if the
+DATALAB_CUBE configuration value is false, DatalabData falls back to SQL.
+"""
+from flask import current_app
+
+from . import db
+from .models import Data, SourceData
+from .utils import DatasetMemo
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+class Dimension:
+    """An integer coded dimension of the cube.
+
+    Each distinct tuple of attributes is stored once and referred to by its
+    position.
+    """
+
+    def __init__(self, fields):
+        """Initialize an empty dimension.
+
+        Args:
+            fields (tuple of str): Names of the attributes of each member.
+        """
+        self.fields = fields
+        self.members = []
+        self.index = {}
+        self.by_code = {}
+
+    def encode(self, member):
+        """Return the integer code for a member, adding it if new.
+
+        Args:
+            member (tuple): Attribute values. The first must be the code.
+
+        Returns:
+            int: Position of the member in this dimension.
+        """
+        position = self.index.get(member)
+        if position is None:
+            position = len(self.members)
+            self.members.append(member)
+            self.index[member] = position
+            self.by_code.setdefault(member[0], []).append(position)
+        return position
+
+    def lookup(self, codes):
+        """Return the positions of all members with the supplied codes.
+
+        Args:
+            codes (seq of str): Codes to look up.
+
+        Returns:
+            list of int: Positions, possibly empty.
+        """
+        return [i for code in codes for i in self.by_code.get(code, ())]
+
+    def column(self, field, fill=None):
+        """Return one attribute of every member as a list.
+
+        Args:
+            field (str): Attribute name.
+            fill: Replacement for None values.
+
+        Returns:
+            list: The attribute values, ordered by position.
+        """
+        i = self.fields.index(field)
+        return [fill if m[i] is None else m[i] for m in self.members]
+
+
+# pylint: disable=too-many-instance-attributes
+class DatalabCube:
+    """Column arrays for the datalab data."""
+
+    def __init__(self, md5):
+        """Initialize empty dimensions and columns.
+
+        Args:
+            md5 (str): The md5 checksum of the source data loaded.
+        """
+        self.md5 = md5
+        self.survey = Dimension(('code', 'label', 'date', 'order'))
+        self.indicator = Dimension(('code',))
+        self.char_grp = Dimension(('code',))
+        self.char = Dimension(('code', 'label', 'order'))
+        self.geography = Dimension(('code', 'label', 'order'))
+        self.country = Dimension(('code', 'label'))
+        self.columns = {}
+
+    @staticmethod
+    def enabled():
+        """Return True if the cube should be used in this application."""
+        return np is not None and current_app.config.get('DATALAB_CUBE', False)
+
+    @staticmethod
+    def current():
+        """Return the cube for the currently loaded source data."""
+        return _CUBE.get(SourceData.get_current_api_md5())
+
+    @staticmethod
+    def load_query():
+        """Return a query of all datalab facts used by the cube.
+
+        Only data without a second characteristic group are included, since
+        that is the only data the datalab serves.
+
+        Returns:
+            A query returning the columns of DatalabData.minimal_joined.
+        """
+        from .queries import DatalabData
+        joined = DatalabData.minimal_joined()
+        filtered = DatalabData.filtered(joined, None, None, None)
+        return filtered.order_by(Data.id)
+
+    @classmethod
+    def from_db(cls, md5):
+        """Build a cube from the database with a single query.
+
+        Args:
+            md5 (str): The md5 checksum of the source data loaded.
+
+        Returns:
+            DatalabCube: The new cube.
+        """
+        cube = cls(md5)
+        cube.load(db.session.execute(
+            cls.load_query().with_labels().statement))
+        return cube
+
+    def load(self, rows):
+        """Encode rows from the load query into column arrays.
+
+        Args:
+            rows (seq of tuple): Rows as returned by the load query.
+        """
+        values, precisions = [], []
+        survey_ids, indicator_ids, char_grp_ids = [], [], []
+        char_ids, geography_ids, country_ids = [], [], []
+        for row in rows:
+            start_date = row[4].strftime('%m-%Y') if row[4] else None
+            values.append(row[0])
+            precisions.append(-1 if row[1] is None else row[1])
+            survey_ids.append(self.survey.encode((row[2], row[3], start_date,
+                                                  row[5])))
+            indicator_ids.append(self.indicator.encode((row[6],)))
+            char_grp_ids.append(self.char_grp.encode((row[7],)))
+            char_ids.append(self.char.encode((row[8], row[9], row[10])))
+            geography_ids.append(self.geography.encode((row[11], row[12],
+                                                        row[13])))
+            country_ids.append(self.country.encode((row[14], row[15])))
+        self.columns = {
+            'value': np.array(values, dtype=np.float64),
+            'precision': np.array(precisions, dtype=np.int64),
+            'survey': np.array(survey_ids, dtype=np.int32),
+            'indicator': np.array(indicator_ids, dtype=np.int32),
+            'char_grp': np.array(char_grp_ids, dtype=np.int32),
+            'char': np.array(char_ids, dtype=np.int32),
+            'geography': np.array(geography_ids, dtype=np.int32),
+            'country': np.array(country_ids, dtype=np.int32)
+        }
+
+    def mask(self, survey_codes, indicator_code, char_grp_code):
+        """Return a boolean mask of the rows matching the filters.
+
+        Args:
+            survey_codes (str): A list of survey codes joined together by a
+                comma
+            indicator_code (str): An indicator code
+            char_grp_code (str): A characteristic group code
+
+        Returns:
+            numpy.ndarray: Boolean mask over the rows of the cube.
+        """
+        mask = np.ones(len(self.columns['value']), dtype=bool)
+        filters = (
+            ('survey', self.survey, survey_codes),
+            ('indicator', self.indicator, indicator_code),
+            ('char_grp', self.char_grp, char_grp_code)
+        )
+        for name, dimension, codes in filters:
+            if codes is not None:
+                if name == 'survey':
+                    codes = codes.split(',')
+                else:
+                    codes = [codes]
+                positions = dimension.lookup(codes)
+                mask &= np.isin(self.columns[name], positions)
+        return mask
+
+    @staticmethod
+    def order_key(dimension, positions):
+        """Return sort keys for rows from a dimension's order attribute.
+
+        Null orders are sorted first, as DatalabData.filter_minimal orders
+        them on every database.
+
+        Args:
+            dimension (Dimension): The dimension with an 'order' attribute.
+            positions (numpy.ndarray): Dimension positions of the rows.
+
+        Returns:
+            numpy.ndarray: Float sort keys, one per row.
+        """
+        order = dimension.column('order', fill=-np.inf)
+        return np.array(order, dtype=np.float64)[positions]
+
+    def filter_minimal(self, survey_codes, indicator_code, char_grp_code,
+                       over_time):
+        # pylint: disable=too-many-locals
+        """Get filtered datalab data and return minimal columns.
+
+        This is equivalent to DatalabData.filter_minimal.
+
+        Args:
+            survey_codes (str): A list of survey codes joined together by a
+                comma
+            indicator_code (str): An indicator code
+            char_grp_code (str): A characteristic group code
+            over_time (bool): Order for time series if True.
+
+        Returns:
+            A list of simple python objects, one for each record found by
+            applying the various filters.
+        """
+        cols = self.columns
+        rows = np.flatnonzero(self.mask(survey_codes, indicator_code,
+                                        char_grp_code))
+        survey_order = self.order_key(self.survey, cols['survey'][rows])
+        char_order = self.order_key(self.char, cols['char'][rows])
+        if over_time:
+            geo_order = self.order_key(self.geography,
+                                       cols['geography'][rows])
+            rows = rows[np.lexsort((survey_order, char_order, geo_order))]
+        else:
+            rows = rows[np.lexsort((char_order, survey_order))]
+        survey = self.survey.members
+        indicator = self.indicator.members
+        char_grp = self.char_grp.members
+        char = self.char.members
+        geography = self.geography.members
+        country = self.country.members
+        json_results = []
+        for value, precision, s_id, i_id, g_id, c_id, geo_id, ctry_id in zip(
+                cols['value'][rows].tolist(),
+                cols['precision'][rows].tolist(),
+                cols['survey'][rows].tolist(),
+                cols['indicator'][rows].tolist(),
+                cols['char_grp'][rows].tolist(),
+                cols['char'][rows].tolist(),
+                cols['geography'][rows].tolist(),
+                cols['country'][rows].tolist()):
+            this_dict = {
+                'value': value,
+                'precision': None if precision < 0 else precision,
+                'survey.id': survey[s_id][0],
+                'survey.date': survey[s_id][2],
+                'survey.label.id': survey[s_id][1],
+                'indicator.id': indicator[i_id][0],
+                'characteristicGroup.id': char_grp[g_id][0],
+                'characteristic.id': char[c_id][0],
+                'characteristic.label.id': char[c_id][1],
+                'geography.label.id': geography[geo_id][1],
+                'geography.id': geography[geo_id][0],
+                'country.label.id': country[ctry_id][1],
+                'country.id': country[ctry_id][0]
+            }
+            json_results.append(this_dict)
+        return json_results
+
+
+_CUBE = DatasetMemo(DatalabCube.from_db)
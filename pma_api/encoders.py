@@ -0,0 +1,167 @@
+"""JSON encoders for responses.
+
+The encoder is chosen with the JSON_ENCODER setting: 'orjson' or 'ujson' to
+use that package, 'json' for the standard library through Flask, or 'auto'
+for the fastest one installed. All of them sort keys and write dates as HTTP
+dates, like Flask's encoder, and return bytes that are put in the response
+as they are.
+
+orjson and ujson are optional dependencies. ujson is only used from version
+5, which can encode dates through a default function.
+"""
+import uuid
+from collections import OrderedDict
+from datetime import date
+
+from flask import json
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def encode_default(obj):
+    """Encode the types that Flask's JSON encoder adds.
+
+    Args:
+        obj: An object that the encoder cannot encode itself.
+
+    Returns:
+        str: Its JSON string.
+
+    Raises:
+        TypeError: If the object cannot be encoded.
+    """
+    if isinstance(obj, date):
+        return http_date(obj.timetuple())
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError('{!r} is not JSON serializable.'.format(obj))
+
+
+class JsonEncoder:
+    """Encoder of the standard library, with Flask's settings."""
+
+    name = 'json'
+
+    @staticmethod
+    def available():
+        """Return whether the encoder can be used."""
+        return True
+
+    @staticmethod
+    def dumps(obj, pretty=False):
+        """Encode an object.
+
+        Args:
+            obj: The object.
+            pretty (bool): Indent, as jsonify does for regular requests.
+
+        Returns:
+            bytes: UTF-8 JSON.
+        """
+        if pretty:
+            text = json.dumps(obj, indent=2, separators=(', ', ': '))
+        else:
+            text = json.dumps(obj, separators=(',', ':'))
+        return text.encode('utf-8')
+
+
+class OrjsonEncoder(JsonEncoder):
+    """Encoder of orjson, which writes bytes directly."""
+
+    name = 'orjson'
+
+    @staticmethod
+    def available():
+        """Return whether orjson is installed and can pass dates through."""
+        return orjson is not None and \
+            hasattr(orjson, 'OPT_PASSTHROUGH_DATETIME') and \
+            hasattr(orjson, 'OPT_NON_STR_KEYS')
+
+    @staticmethod
+    def dumps(obj, pretty=False):
+        """Encode an object.
+
+        Args:
+            obj: The object.
+            pretty (bool): Indent, as jsonify does for regular requests.
+
+        Returns:
+            bytes: UTF-8 JSON.
+        """
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=encode_default, option=option)
+
+
+class UjsonEncoder(JsonEncoder):
+    """Encoder of ujson."""
+
+    name = 'ujson'
+
+    @staticmethod
+    def available():
+        """Return whether ujson is installed and takes a default function."""
+        if ujson is None:
+            return False
+        try:
+            ujson.dumps(None, default=encode_default)
+        except TypeError:
+            return False
+        return True
+
+    @staticmethod
+    def dumps(obj, pretty=False):
+        """Encode an object.
+
+        Args:
+            obj: The object.
+            pretty (bool): Indent, as jsonify does for regular requests.
+
+        Returns:
+            bytes: UTF-8 JSON.
+        """
+        text = ujson.dumps(obj, default=encode_default, sort_keys=True,
+                           indent=2 if pretty else 0, ensure_ascii=False,
+                           escape_forward_slashes=False)
+        return text.encode('utf-8')
+
+
+# Encoders by name, fastest first.
+ENCODERS = OrderedDict((encoder.name, encoder) for encoder in
+                       (OrjsonEncoder, UjsonEncoder, JsonEncoder))
+
+
+def get_encoder(name='auto'):
+    """Return a JSON encoder.
+
+    Args:
+        name (str): Name of the encoder, or 'auto' for the fastest one
+            installed.
+
+    Returns:
+        class: The encoder.
+
+    Raises:
+        ValueError: If the encoder is unknown or not installed.
+    """
+    if name == 'auto':
+        return next(encoder for encoder in ENCODERS.values()
+                    if encoder.available())
+    encoder = ENCODERS.get(name)
+    if encoder is None or not encoder.available():
+        msg = 'JSON encoder "{}" is unknown or not installed.'
+        raise ValueError(msg.format(name))
+    return encoder
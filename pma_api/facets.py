@@ -0,0 +1,140 @@
+"""Facet index of valid datalab selections.
+
+A datalab selection is valid if there is data for its (survey, indicator,
+characteristic group) combination. Every distinct combination in the data is
+numbered, and each survey, indicator, and characteristic group code is mapped
+to a bitset of the combinations it takes part in. Valid selections are then
+found with bitwise intersections instead of table scans.
+
+The index is built once per source data md5.
+"""
+from .models import Indicator, SourceData, Survey
+from .utils import DatasetMemo
+
+
+class FacetIndex:
+    """Bitsets of (survey, indicator, characteristic group) combinations."""
+
+    def __init__(self, md5, combos):
+        """Build bitsets for every code.
+
+        Args:
+            md5 (str): The md5 checksum of the source data loaded.
+            combos (iterable of tuple): Distinct (survey code, indicator code,
+                characteristic group code) tuples.
+        """
+        self.md5 = md5
+        self.surveys = {}
+        self.indicators = {}
+        self.char_grps = {}
+        size = 0
+        for survey, indicator, char_grp in combos:
+            bit = 1 << size
+            size += 1
+            self.surveys[survey] = self.surveys.get(survey, 0) | bit
+            self.indicators[indicator] = \
+                self.indicators.get(indicator, 0) | bit
+            self.char_grps[char_grp] = self.char_grps.get(char_grp, 0) | bit
+        self.all_bits = (1 << size) - 1
+
+    @staticmethod
+    def current():
+        """Return the facet index for the currently loaded source data."""
+        return _FACETS.get(SourceData.get_current_api_md5())
+
+    @classmethod
+    def from_db(cls, md5):
+        """Build a facet index from the database with a single query.
+
+        Args:
+            md5 (str): The md5 checksum of the source data loaded.
+
+        Returns:
+            FacetIndex: The new index.
+        """
+        from .queries import DatalabData
+        select_args = (Survey.code, Indicator.code, DatalabData.char_grp1.code)
+        joined = DatalabData.all_joined(*select_args)
+        return cls(md5, joined.distinct().all())
+
+    def select(self, bitsets, codes):
+        """Return the union of bitsets for the supplied codes.
+
+        Args:
+            bitsets (dict): One of the code to bitset maps of this index.
+            codes (seq of str): Codes to select. If empty or None, everything
+                is selected.
+
+        Returns:
+            int: A bitset of combinations.
+        """
+        if not codes:
+            return self.all_bits
+        bits = 0
+        for code in codes:
+            bits |= bitsets.get(code, 0)
+        return bits
+
+    @staticmethod
+    def matching(bitsets, selected):
+        """Return the sorted codes that have any selected combination.
+
+        Args:
+            bitsets (dict): One of the code to bitset maps of this index.
+            selected (int): A bitset of combinations.
+
+        Returns:
+            list of str: Sorted codes.
+        """
+        return sorted(code for code, bits in bitsets.items()
+                      if bits & selected)
+
+    def combos(self, survey_list=None, indicator=None, char_grp=None):
+        """Get lists of valid selections given a current selection.
+
+        Each list is restricted by the selections of the other two areas,
+        never by its own.
+
+        Args:
+            survey_list (list of str): Survey codes, or empty if none.
+            indicator (str): An indicator code, or None.
+            char_grp (str): A characteristic group code, or None.
+
+        Returns:
+            tuple: Sorted lists of survey, indicator, and characteristic group
+            codes.
+        """
+        by_survey = self.select(self.surveys, survey_list)
+        by_indicator = self.select(
+            self.indicators, None if indicator is None else [indicator])
+        by_char_grp = self.select(
+            self.char_grps, None if char_grp is None else [char_grp])
+        surveys = self.matching(self.surveys, by_indicator & by_char_grp)
+        indicators = self.matching(self.indicators, by_survey & by_char_grp)
+        char_grps = self.matching(self.char_grps, by_survey & by_indicator)
+        return surveys, indicators, char_grps
+
+    def co_occurring(self, survey_list):
+        """Map indicators and characteristic groups to each other.
+
+        Args:
+            survey_list (list of str): Survey codes to restrict to.
+
+        Returns:
+            tuple: Dict of indicator code to sorted characteristic group
+            codes, and dict of characteristic group code to sorted indicator
+            codes.
+        """
+        by_survey = self.select(self.surveys, survey_list)
+        indicator_dict = {
+            code: self.matching(self.char_grps, bits & by_survey)
+            for code, bits in self.indicators.items() if bits & by_survey
+        }
+        char_grp_dict = {
+            code: self.matching(self.indicators, bits & by_survey)
+            for code, bits in self.char_grps.items() if bits & by_survey
+        }
+        return indicator_dict, char_grp_dict
+
+
+_FACETS = DatasetMemo(FacetIndex.from_db)
@@ -0,0 +1,632 @@
+"""Bulk loading of source data into the database.
+
+Creating one model instance per row of a sheet costs a query for every code
+and string that the constructor resolves to an id, and a commit for every
+new string. Instead, rows are converted with the same conversions as the
+constructors (ApiModel.prepare), resolving ids from dicts that are loaded
+once and interning new strings in memory, and whole batches are written with
+a single bulk insert, or COPY on PostgreSQL.
+
+Workbooks are read with WorkbookReader, which streams xlsx sheets row by row
+if openpyxl is installed, so memory use does not grow with the workbook.
+Sheets that do not create records others refer to, i.e. the data sheets, can
+be parsed in a pool of worker processes with parse_sheet, while the main
+process writes the results in order. A parsed sheet is held in memory, so at
+most one sheet per worker is parsed ahead.
+
+New source data can also be reloaded in place: records are matched by their
+natural key, and only new, changed and removed records are written.
+"""
+import csv
+import logging
+from collections import deque
+from io import StringIO
+from itertools import chain, islice
+from multiprocessing import Pool
+
+from sqlalchemy import select, union
+
+import xlrd
+
+from . import db
+from .models import EnglishString
+from .utils import hash64, next64
+
+try:
+    import openpyxl
+except ImportError:  # pragma: no cover
+    openpyxl = None
+
+
+# Rows written per bulk insert.
+BATCH_SIZE = 10000
+# Ids per statement when updating or deleting records by id.
+ID_CHUNK_SIZE = 500
+
+
+class WorkbookReader:
+    """Read the sheets of a workbook row by row.
+
+    With openpyxl, xlsx files are opened in read-only mode, which parses each
+    sheet as it is iterated instead of loading the whole workbook. Otherwise,
+    or for other formats, xlrd is used.
+
+    Cell values are given as xlrd gives them: numbers as float, and empty
+    cells as ''. Rows of empty cells are skipped by the streaming reader.
+    """
+
+    def __init__(self, path):
+        """Open a workbook.
+
+        Args:
+            path (str): Path to the workbook.
+        """
+        self.streaming = openpyxl is not None and path.endswith('.xlsx')
+        if self.streaming:
+            self.book = openpyxl.load_workbook(path, read_only=True,
+                                               data_only=True)
+        else:
+            self.book = xlrd.open_workbook(path, on_demand=True)
+
+    def __enter__(self):
+        """Return this reader."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the workbook."""
+        self.close()
+
+    def sheet_names(self):
+        """Return the names of the sheets, in workbook order."""
+        if self.streaming:
+            return self.book.sheetnames
+        return self.book.sheet_names()
+
+    def rows(self, name):
+        """Iterate over the rows of a sheet.
+
+        Args:
+            name (str): Name of the sheet.
+
+        Yields:
+            list: Cell values of a row. The first row is the header.
+        """
+        if not self.streaming:
+            for row in self.book.sheet_by_name(name).get_rows():
+                yield [cell.value for cell in row]
+            return
+        for row in self.book[name].iter_rows():
+            values = [self.cell_value(cell.value) for cell in row]
+            if any(value != '' for value in values):
+                yield values
+
+    @staticmethod
+    def cell_value(value):
+        """Convert an openpyxl cell value to the xlrd equivalent.
+
+        Args:
+            value: The value read by openpyxl.
+
+        Returns:
+            The value that xlrd would read.
+        """
+        if value is None:
+            return ''
+        if isinstance(value, (bool, int)):
+            return float(value)
+        return value
+
+    def close(self):
+        """Close the workbook."""
+        if self.streaming:
+            self.book.close()
+        else:
+            self.book.release_resources()
+
+
+def convert_rows(model, name, rows, lookup):
+    """Convert the rows of a sheet to column values of a model.
+
+    Args:
+        model (class): SqlAlchemy model class.
+        name (str): Name of the sheet, for error messages.
+        rows (iterable of list): Cell values. The first row is the header.
+        lookup (IngestLookup): Resolves codes and strings to ids.
+
+    Yields:
+        dict: Column values of a row.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    for i, row in enumerate(rows, start=2):
+        try:
+            yield model.to_mapping(dict(zip(header, row)), lookup)
+        except Exception:
+            msg = 'Error when processing row {} of "{}". Cell values: {}'
+            msg = msg.format(i, name, row)
+            logging.error(msg)
+            raise
+
+
+def parse_sheet(task):
+    """Read and convert a whole sheet, e.g. in a worker process.
+
+    The lookup must already have the codes of every model that the rows
+    refer to, and the rows must not refer to English strings, so that no
+    query is made.
+
+    Args:
+        task (tuple): Path to the workbook, name of the sheet, model class
+            and IngestLookup.
+
+    Returns:
+        list of dict: Column values of the rows.
+    """
+    path, name, model, lookup = task
+    with WorkbookReader(path) as reader:
+        return list(convert_rows(model, name, reader.rows(name), lookup))
+
+
+class IngestLookup:
+    """Resolve codes and English strings to ids from in-memory dicts.
+
+    New English strings are interned: they get an id and a code right away,
+    and are written in batches with pending_strings before the rows that
+    refer to them.
+    """
+
+    def __init__(self):
+        """Initialize with nothing loaded."""
+        self.code_ids = {}
+        self.english_ids = None
+        self.english_codes = None
+        self.next_english_id = None
+        self.new_strings = []
+        self.changed_strings = {}
+
+    def forget(self, model):
+        """Forget the codes of a model, after new records are inserted.
+
+        Args:
+            model (class): SqlAlchemy model class.
+        """
+        self.code_ids.pop(model, None)
+
+    def code_id(self, model, code):
+        """Return the id of the record with a code.
+
+        Args:
+            model (class): SqlAlchemy model class with a 'code' column.
+            code (str): The code.
+
+        Returns:
+            int: The id, or None if there is no such record.
+        """
+        if model not in self.code_ids:
+            self.code_ids[model] = dict(db.session.query(model.code,
+                                                         model.id))
+        return self.code_ids[model].get(code)
+
+    def load_codes(self, models):
+        """Load the codes of models, so that code_id makes no query.
+
+        Args:
+            models (iterable of class): SqlAlchemy model classes.
+        """
+        for model in models:
+            self.code_id(model, None)
+
+    def english_id(self, english, create=True):
+        """Return the id of an English string, interning it if new.
+
+        Args:
+            english (str): The string in English.
+            create (bool): Intern the string if it does not exist yet.
+
+        Returns:
+            int: The id of the first record with the string.
+
+        Raises:
+            KeyError: If the string does not exist and create is False.
+        """
+        self.load_english()
+        record_id = self.english_ids.get(english)
+        if record_id is None:
+            if not create:
+                raise KeyError('No English string "{}"'.format(english))
+            record_id = self.intern(english)
+        return record_id
+
+    def english_code_id(self, english, code):
+        """Return the id of the English string with a code.
+
+        The string is interned, or updated if its text differs.
+
+        Args:
+            english (str): The string in English.
+            code (str): The code for the string.
+
+        Returns:
+            int: The id of the record.
+        """
+        self.load_english()
+        if code not in self.english_codes:
+            return self.intern(english, code)
+        record_id, old_english = self.english_codes[code]
+        if old_english != english:
+            if self.english_ids.get(old_english) == record_id:
+                del self.english_ids[old_english]
+            self.english_ids.setdefault(english, record_id)
+            self.english_codes[code] = (record_id, english)
+            self.changed_strings[record_id] = {'id': record_id,
+                                               'english': english}
+        return record_id
+
+    def intern(self, english, code=None):
+        """Assign an id and a code to a new English string.
+
+        Args:
+            english (str): The string in English.
+            code (str): The code for the string. None if it should be random.
+
+        Returns:
+            int: The id of the new record.
+        """
+        while code is None or code in self.english_codes:
+            code = next64()
+        record_id = self.next_english_id
+        self.next_english_id += 1
+        self.new_strings.append({'id': record_id, 'code': code,
+                                 'english': english})
+        self.english_ids.setdefault(english, record_id)
+        self.english_codes[code] = (record_id, english)
+        return record_id
+
+    def load_english(self):
+        """Load all English strings, if not done yet."""
+        if self.english_ids is not None:
+            return
+        self.english_ids = {}
+        self.english_codes = {}
+        self.next_english_id = 1
+        query = db.session.query(EnglishString.id, EnglishString.code,
+                                 EnglishString.english)\
+            .order_by(EnglishString.id)
+        for record_id, code, english in query:
+            self.english_ids.setdefault(english, record_id)
+            self.english_codes[code] = (record_id, english)
+            self.next_english_id = record_id + 1
+
+    def pending_strings(self):
+        """Return and forget the English strings not written yet.
+
+        Returns:
+            tuple: Column values of new records, and of changed records.
+        """
+        new, changed = self.new_strings, list(self.changed_strings.values())
+        self.new_strings = []
+        self.changed_strings = {}
+        return new, changed
+
+
+class BulkLoader:
+    """Convert rows of source data and insert them in batches."""
+
+    def __init__(self):
+        """Initialize the lookup and choose how rows are written."""
+        self.lookup = IngestLookup()
+        self.use_copy = db.engine.dialect.name == 'postgresql'
+        self.removed = []
+        self.codes = {}
+
+    def load_rows(self, model, name, rows):
+        """Load the rows of a sheet into the table of a model.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            name (str): Name of the sheet, for error messages.
+            rows (iterable of list): Cell values. The first row is the header.
+        """
+        self.load_mappings(model, convert_rows(model, name, rows,
+                                               self.lookup))
+
+    def load_sheets(self, model, path, names, processes=None):
+        """Load sheets in order, parsing them in worker processes.
+
+        Rows of the sheets may only refer to records of other models, by
+        code, e.g. data refers to surveys and indicators.
+
+        A worker returns a whole parsed sheet, so at most one sheet per
+        process is parsed ahead of the one being written, to bound memory.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            path (str): Path to the workbook.
+            names (list of str): Names of the sheets.
+            processes (int): Number of worker processes. If None or 1, sheets
+                are streamed in this process.
+        """
+        if processes is None or processes == 1:
+            with WorkbookReader(path) as reader:
+                for name in names:
+                    self.load_rows(model, name, reader.rows(name))
+            return
+        related = [relationship.mapper.class_
+                   for relationship in model.__mapper__.relationships]
+        self.lookup.load_codes(related)
+        tasks = iter([(path, name, model, self.lookup) for name in names])
+        pool = Pool(processes)
+        try:
+            pending = deque(pool.apply_async(parse_sheet, (task,))
+                            for task in islice(tasks, processes))
+            while pending:
+                mappings = pending.popleft().get()
+                for task in islice(tasks, 1):
+                    pending.append(pool.apply_async(parse_sheet, (task,)))
+                self.load_mappings(model, mappings)
+                del mappings
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def load_mappings(self, model, mappings):
+        """Insert column values in batches and commit.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            mappings (iterable of dict): Column values, all with the same
+                keys.
+        """
+        batch = []
+        for mapping in mappings:
+            self.check_code(model, mapping)
+            batch.append(mapping)
+            if len(batch) == BATCH_SIZE:
+                self.write(model, batch)
+                batch = []
+        if batch:
+            self.write(model, batch)
+        db.session.commit()
+        self.lookup.forget(model)
+
+    def reload_rows(self, model, sheets):
+        """Write the differences between sheets and the table of a model.
+
+        Records are matched by the natural key of the model. New records are
+        inserted and changed ones updated, keeping their id. Removed records
+        are deleted later by delete_removed, once nothing refers to them.
+        Nothing is committed.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            sheets (list of tuple): Name and rows of each sheet, as given to
+                load_rows.
+
+        Returns:
+            tuple: Number of records inserted, updated and to be removed.
+
+        Raises:
+            ValueError: If two rows have the same natural key, or the same
+                derived code.
+        """
+        self.codes.pop(model, None)
+        existing = self.existing_records(model)
+        mappings = chain.from_iterable(
+            convert_rows(model, name, rows, self.lookup)
+            for name, rows in sheets)
+        integers = self.integer_columns(model)
+        inserts, updates, seen = [], [], set()
+        for mapping in mappings:
+            self.coerce_integers(mapping, integers)
+            key = tuple(mapping.get(name) for name in model.natural_key)
+            if key in seen:
+                msg = 'Duplicate key {} in new source data for table "{}"'
+                raise ValueError(msg.format(key, model.__tablename__))
+            seen.add(key)
+            self.check_code(model, mapping)
+            record = existing.get(key)
+            if record is None:
+                inserts.append(mapping)
+                continue
+            if any(record[name] != value for name, value in mapping.items()):
+                mapping['id'] = record['id']
+                updates.append(mapping)
+        removed = [record['id'] for key, record in existing.items()
+                   if key not in seen]
+        self.clear_unique(model,
+                          removed + [mapping['id'] for mapping in updates])
+        self.flush_strings()
+        if updates:
+            db.session.bulk_update_mappings(model, updates)
+        for chunk in range(0, len(inserts), BATCH_SIZE):
+            self.insert(model, inserts[chunk:chunk + BATCH_SIZE])
+        self.removed.append((model, removed))
+        self.lookup.forget(model)
+        return len(inserts), len(updates), len(removed)
+
+    def check_code(self, model, mapping):
+        """Give a record another code if a record loaded so far has its code.
+
+        This applies to models whose code is not their natural key, e.g.
+        data codes, which are short digests of the natural key. Two keys may
+        then rarely get the same code, and since the code is unique, loading
+        would fail on every run. Instead, the record loaded later gets the
+        code rehashed with a counter. The codes are the same on every load of
+        the same workbook, as long as its rows keep their order.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            mapping (dict): Column values of a record. Its code may be
+                changed.
+        """
+        code = mapping.get('code')
+        if code is None or 'code' in model.natural_key:
+            return
+        key = tuple(mapping.get(name) for name in model.natural_key)
+        codes = self.codes.setdefault(model, {})
+        salt = 0
+        while codes.setdefault(code, key) != key:
+            salt += 1
+            code = hash64(mapping['code'], salt)
+        if salt:
+            msg = 'Record %s of table "%s" has the code of record %s, and ' \
+                'gets code "%s" instead of "%s".'
+            logging.warning(msg, key, model.__tablename__,
+                            codes[mapping['code']], code, mapping['code'])
+            mapping['code'] = code
+
+    @staticmethod
+    def existing_records(model):
+        """Return the records of a model by natural key.
+
+        Args:
+            model (class): SqlAlchemy model class.
+
+        Returns:
+            dict: Column values of each record, by natural key tuple.
+        """
+        result = {}
+        for record in db.session.execute(model.__table__.select()):
+            record = dict(record)
+            result[tuple(record[name] for name in model.natural_key)] = record
+        return result
+
+    @staticmethod
+    def clear_unique(model, ids):
+        """Set unique columns to NULL, other than the natural key.
+
+        Unique values may move between records on reload, so they are
+        cleared on the records to be updated or removed first.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            ids (list of int): Ids of the records.
+        """
+        table = model.__table__
+        unique = [column.name for column in table.columns
+                  if column.unique and column.name not in model.natural_key]
+        if not unique:
+            return
+        for chunk in range(0, len(ids), ID_CHUNK_SIZE):
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_(ids[chunk:chunk + ID_CHUNK_SIZE]))
+                .values({name: None for name in unique}))
+
+    def delete_removed(self):
+        """Delete records removed by reload_rows, and unused English strings.
+
+        Records are deleted in the reverse order of reloading, so that no
+        record is deleted while another refers to it. Nothing is committed.
+
+        Returns:
+            int: Number of English strings deleted.
+        """
+        while self.removed:
+            model, ids = self.removed.pop()
+            for chunk in range(0, len(ids), ID_CHUNK_SIZE):
+                model.query.filter(
+                    model.id.in_(ids[chunk:chunk + ID_CHUNK_SIZE]))\
+                    .delete(synchronize_session=False)
+        english_table = EnglishString.__table__
+        # NULLs are left out, or NOT IN would match no string at all.
+        used = [select([column]).where(column.isnot(None))
+                for table in db.metadata.sorted_tables
+                for column in table.columns
+                for key in column.foreign_keys
+                if key.column.table is english_table]
+        return EnglishString.query\
+            .filter(~EnglishString.id.in_(union(*used)))\
+            .delete(synchronize_session=False)
+
+    def write(self, model, mappings):
+        """Insert a batch of column values after the strings they refer to.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            mappings (list of dict): Column values, all with the same keys.
+        """
+        self.flush_strings()
+        self.insert(model, mappings)
+
+    def flush_strings(self):
+        """Write the English strings interned or changed by the lookup."""
+        new_strings, changed_strings = self.lookup.pending_strings()
+        if new_strings:
+            self.insert(EnglishString, new_strings)
+            self.reset_sequence(EnglishString.__tablename__)
+        if changed_strings:
+            db.session.bulk_update_mappings(EnglishString, changed_strings)
+
+    def reset_sequence(self, table):
+        """Continue the id sequence of a table after explicitly set ids.
+
+        This is only needed on PostgreSQL.
+
+        Args:
+            table (str): Name of the table.
+        """
+        if self.use_copy:
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT max(id) FROM {0}))".format(table))
+
+    def insert(self, model, mappings):
+        """Insert a batch of column values.
+
+        Args:
+            model (class): SqlAlchemy model class.
+            mappings (list of dict): Column values, all with the same keys.
+        """
+        integers = self.integer_columns(model)
+        for mapping in mappings:
+            self.coerce_integers(mapping, integers)
+        if self.use_copy:
+            self.copy(model.__tablename__, mappings)
+        else:
+            db.session.bulk_insert_mappings(model, mappings)
+
+    @staticmethod
+    def integer_columns(model):
+        """Return the names of the integer columns of a model.
+
+        Args:
+            model (class): SqlAlchemy model class.
+
+        Returns:
+            list of str: The column names.
+        """
+        return [column.name for column in model.__table__.columns
+                if isinstance(column.type, db.Integer)]
+
+    @staticmethod
+    def coerce_integers(mapping, integers):
+        """Convert integral floats, as read from workbooks, to int.
+
+        Args:
+            mapping (dict): Column values, changed in place.
+            integers (list of str): Names of the integer columns.
+        """
+        for name in integers:
+            value = mapping.get(name)
+            if isinstance(value, float) and value.is_integer():
+                mapping[name] = int(value)
+
+    @staticmethod
+    def copy(table, mappings):
+        """Insert a batch of column values with PostgreSQL COPY.
+
+        Args:
+            table (str): Name of the table.
+            mappings (list of dict): Column values, all with the same keys.
+        """
+        columns = list(mappings[0])
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for mapping in mappings:
+            writer.writerow([mapping[column] for column in columns])
+        buffer.seek(0)
+        statement = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+            table, ', '.join('"{}"'.format(column) for column in columns))
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(statement, buffer)
@@ -1,14 +1,24 @@
 # TODO (jkp 2017-08-29) figure out a way to break this up
 # pylint: disable=too-many-lines
 """Model definitions."""
+import gzip
 import os
 from datetime import datetime
-from hashlib import md5
+from io import BytesIO
+from types import MappingProxyType
 
-from flask import url_for
+from flask import Response, current_app, request, url_for
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
 
 from . import db
-from .utils import next64
+from .utils import (DatasetMemo, HitTally, file_md5, hash64, next64,
+                    request_memo)
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
 
 class ApiModel(db.Model):
@@ -17,6 +27,8 @@ class ApiModel(db.Model):
     __abstract__ = True
 
     ignore_field_prefix = '__'
+    # Columns that identify a record across loads of source data.
+    natural_key = ('code',)
 
     def __init__(self, *args, **kwargs):
         """Perform common tasks on kwargs."""
@@ -50,7 +62,7 @@ class ApiModel(db.Model):
         kwargs[source_key] = this_date
 
     @staticmethod
-    def update_kwargs_english(kwargs, source_key, target_key):
+    def update_kwargs_english(kwargs, source_key, target_key, lookup=None):
         """Translate API query parameters to equivalent in model.
 
         API URL query parameters are in many case abstracted away from the
@@ -64,9 +76,13 @@ class ApiModel(db.Model):
             target_key (str): The equivalent model field.
             **kwargs (dict): The keyword argument representation of query
                 parameters submitted by the API request.
+            lookup: An object with the methods of ingest.IngestLookup to
+                resolve the string, or None to query it.
         """
         english = kwargs.pop(source_key)
-        if english:
+        if english and lookup is not None:
+            kwargs[target_key] = lookup.english_id(english)
+        elif english:
             record = EnglishString.query.filter_by(english=english).first()
             if record:
                 kwargs[target_key] = record.id
@@ -77,7 +93,9 @@ class ApiModel(db.Model):
             kwargs[target_key] = None
 
     @staticmethod
-    def set_kwargs_id(kwargs, source_key, target_key, model, required=True):
+    def set_kwargs_id(kwargs, source_key, target_key, model, required=True,
+                      lookup=None):
+        # pylint: disable=too-many-arguments
         """Set id of data model field based on code.
 
         Args:
@@ -87,6 +105,8 @@ class ApiModel(db.Model):
             required (bool): True if code required for lookup.
             **kwargs (dict): The keyword argument representation of query
                 parameters submitted by the API request.
+            lookup: An object with the methods of ingest.IngestLookup to
+                resolve the code, or None to query it.
 
         Raises:
             KeyError: If identification code for record was not supplied or did
@@ -100,13 +120,16 @@ class ApiModel(db.Model):
         elif code == '' and not required:
             kwargs[target_key] = None
         else:
-            record = model.query.filter_by(code=code).first()
-            if record:
-                kwargs[target_key] = record.id
+            if lookup is not None:
+                record_id = lookup.code_id(model, code)
             else:
+                record = model.query.filter_by(code=code).first()
+                record_id = record.id if record else None
+            if record_id is None:
                 msg = 'No record with code "{}" in "{}"'
                 msg = msg.format(code, model.__tablename__)
                 raise KeyError(msg)
+            kwargs[target_key] = record_id
 
     @staticmethod
     def empty_to_none(kwargs):
@@ -139,6 +162,39 @@ class ApiModel(db.Model):
         new_dict = {'.'.join((prefix, k)): v for k, v in old_dict.items()}
         return new_dict
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        # pylint: disable=unused-argument
+        """Convert the fields of a row of source data to model fields.
+
+        Models override this with the conversions of their constructor, so
+        that rows can also be converted without creating instances.
+
+        Args:
+            kwargs (dict): Fields of a row of source data, changed in place.
+            lookup: An object with the methods of ingest.IngestLookup to
+                resolve codes and strings to ids, or None to query them.
+        """
+
+    @classmethod
+    def to_mapping(cls, kwargs, lookup=None):
+        """Convert a row of source data into column values for bulk inserts.
+
+        This does what the constructor does, without creating an instance.
+
+        Args:
+            kwargs (dict): Fields of a row of source data, changed in place.
+            lookup: An object with the methods of ingest.IngestLookup to
+                resolve codes and strings to ids, or None to query them.
+
+        Returns:
+            dict: Column values.
+        """
+        cls.prepare(kwargs, lookup)
+        cls.prune_ignored_fields(kwargs)
+        cls.empty_to_none(kwargs)
+        return kwargs
+
     @classmethod
     def get_by_code(cls, lookup):
         """Return an item by code or list of codes.
@@ -158,6 +214,40 @@ class ApiModel(db.Model):
         records = query.all()
         return records
 
+    @staticmethod
+    def joined(via, *attrs):
+        """Return options to eagerly load relationships with a join.
+
+        Args:
+            via: A loader option for the parent relationship, or None if the
+                relationships belong to the queried model itself.
+            *attrs: Relationship attributes to load.
+
+        Returns:
+            list: Loader options.
+        """
+        if via is None:
+            return [joinedload(attr) for attr in attrs]
+        return [via.joinedload(attr) for attr in attrs]
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        # pylint: disable=unused-argument
+        """Return loader options for the relationships read by full_json.
+
+        Passing these options to a query loads everything that full_json
+        needs in the same SQL statement, instead of one lazy load per
+        relationship and record.
+
+        Args:
+            via: A loader option for the parent relationship, or None if this
+                model is the one being queried.
+
+        Returns:
+            list: Loader options.
+        """
+        return []
+
 
 # pylint: disable=too-few-public-methods
 class SourceData(db.Model):
@@ -168,20 +258,31 @@ class SourceData(db.Model):
     name = db.Column(db.String)
     type = db.Column(db.String, index=True)
     md5_checksum = db.Column(db.String)
-    blob = db.Column(db.LargeBinary)
+    # The blob is the whole source file, so only load it when accessed.
+    blob = db.deferred(db.Column(db.LargeBinary))
     created_on = db.Column(db.DateTime, default=db.func.now(),
                            onupdate=db.func.now(), index=True)
 
-    def __init__(self, path):
-        """Metadata init."""
+    def __init__(self, path, store_blob=True):
+        """Metadata init.
+
+        The md5 checksum is computed in chunks, so the whole file is only
+        read into memory if it is stored.
+
+        Args:
+            path (str): Path to the source file.
+            store_blob (bool): Store the file itself in the record.
+        """
         filename = os.path.splitext(os.path.basename(path))[0]
         self.name = filename
         if filename.startswith('api'):
             self.type = 'api'
         elif filename.startswith('ui'):
             self.type = 'ui'
-        self.blob = open(path, 'rb').read()
-        self.md5_checksum = md5(self.blob).hexdigest()
+        self.md5_checksum = file_md5(path)
+        if store_blob:
+            with open(path, 'rb') as source:
+                self.blob = source.read()
 
     @classmethod
     def get_current_api_data(cls):
@@ -189,6 +290,54 @@ class SourceData(db.Model):
         record = cls.query.filter_by(type='api').first()
         return record
 
+    @classmethod
+    def get_current_api_md5(cls):
+        """Return the md5 checksum of the most recent API data.
+
+        Only the checksum column is selected, and only once per request.
+
+        Returns:
+            str: The md5 checksum, or None if no API data has been loaded.
+        """
+        def query_md5():
+            """Query the checksum."""
+            record = db.session.query(cls.md5_checksum)\
+                .filter(cls.type == 'api').first()
+            return record[0] if record else None
+        return request_memo('api_md5', query_md5)
+
+    @classmethod
+    def get_version(cls):
+        """Return a key that changes whenever any source data is reloaded.
+
+        Only the id, checksum and creation time columns are selected, and
+        only once per request. The creation time is included so that loading
+        the same files again, e.g. into a new dataset, changes the key.
+
+        Returns:
+            tuple: Id, md5 checksum and created_on of each record.
+        """
+        def query_version():
+            """Query ids, checksums and creation times."""
+            records = db.session.query(cls.id, cls.md5_checksum,
+                                       cls.created_on).order_by(cls.id)
+            return tuple(tuple(record) for record in records)
+        return request_memo('source_data_version', query_version)
+
+    @classmethod
+    def query_freshness(cls):
+        """Query the version key and the time of the latest load.
+
+        Returns:
+            tuple: The key returned by get_version, and the latest created_on
+            datetime, or None if there are no records.
+        """
+        records = db.session.query(cls.id, cls.md5_checksum, cls.created_on)\
+            .order_by(cls.id).all()
+        version = tuple(tuple(record) for record in records)
+        created = [record[2] for record in records if record[2] is not None]
+        return version, max(created) if created else None
+
     def to_json(self):
         """Return dictionary ready to convert to JSON as response.
 
@@ -203,26 +352,271 @@ class SourceData(db.Model):
         }
         return result
 
+    @classmethod
+    def all_to_json(cls):
+        """Return to_json of every record.
+
+        The result is memoized per process and rebuilt only when a record is
+        added or removed.
+
+        Returns:
+            list of dict: API response ready to be JSONified.
+        """
+        return _SOURCE_DATA_JSON.get(cls.get_version())
+
+    @classmethod
+    def build_all_to_json(cls, key):
+        # pylint: disable=unused-argument
+        """Build to_json of every record.
+
+        Args:
+            key (tuple): Ids, md5 checksums and creation times of the
+                records.
+
+        Returns:
+            list of dict: API response ready to be JSONified.
+        """
+        return [record.to_json() for record in cls.query.order_by(cls.id)]
+
+
+_SOURCE_DATA_JSON = DatasetMemo(SourceData.build_all_to_json)
+
 
 class Cache(db.Model):
-    """Cache for API responses."""
+    """Cache for API responses.
+
+    Response bodies are compressed once when saved: always with gzip, and
+    also with brotli if the brotli package is installed.
+
+    Hits are counted in memory and added to the table in batches. The total
+    size of the table is kept within a budget by trim.
+    """
 
     __tablename__ = 'cache'
     key = db.Column(db.String, primary_key=True)
-    value = db.Column(db.String, nullable=False)
+    value_gzip = db.Column(db.LargeBinary, nullable=False)
+    value_brotli = db.Column(db.LargeBinary)
     mimetype = db.Column(db.String)
-    source_data_md5 = db.Column(db.String)
+    source_data_md5 = db.Column(db.String, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    last_accessed = db.Column(db.DateTime, nullable=False,
+                              default=datetime.utcnow)
+
+    # Brotli quality, lower than the maximum since responses may be compressed
+    # while a client waits.
+    brotli_quality = 9
 
     @classmethod
     def get(cls, key):
         """Return a record by key."""
         return cls.query.filter_by(key=key).first()
 
+    @classmethod
+    def check_schema(cls):
+        """Check that the cache table has the columns of this model.
+
+        The table is not migrated when its columns change, so a database
+        from an older version fails here instead of on the first request.
+
+        Raises:
+            RuntimeError: If the table exists but lacks some columns.
+        """
+        inspector = inspect(db.engine)
+        if cls.__tablename__ not in inspector.get_table_names():
+            return
+        found = {column['name'] for column in
+                 inspector.get_columns(cls.__tablename__)}
+        missing = sorted(set(cls.__table__.columns.keys()) - found)
+        if missing:
+            msg = 'The cache table lacks columns {}. Recreate it with ' \
+                '"python manage.py cache_responses --recreate".'
+            raise RuntimeError(msg.format(', '.join(missing)))
+
+    @classmethod
+    def lookup(cls, key, source_data_md5):
+        """Return a cached response made from the supplied source data.
+
+        The in-process cache of the application is checked first, and the
+        cache table, which is shared by all processes, second.
+
+        Args:
+            key (str): The cache key.
+            source_data_md5 (str): The md5 of the current source data.
+
+        Returns:
+            Cache: A record that is not attached to any database session, or
+            None if there is no valid cached response.
+        """
+        record = current_app.local_cache.get(key)
+        if record is None or record.source_data_md5 != source_data_md5:
+            record = cls.get(key)
+            if record is None or record.source_data_md5 != source_data_md5:
+                return None
+            record = record.detached_copy()
+            record.keep_local()
+        _CACHE_HITS.add(key)
+        cls.flush_hits(current_app.config['CACHE_HITS_FLUSH_SECONDS'])
+        return record
+
+    @classmethod
+    def flush_hits(cls, interval=0):
+        """Add the hits counted in this process to the table.
+
+        The update runs in a transaction of its own, so the current session
+        is not committed.
+
+        Args:
+            interval (float): Only write if at least this many seconds have
+                passed since the last write.
+        """
+        hits = _CACHE_HITS.drain(interval)
+        if not hits:
+            return
+        table = cls.__table__
+        statement = table.update()\
+            .where(table.c.key == db.bindparam('hit_key'))\
+            .values(hits=table.c.hits + db.bindparam('hit_count'),
+                    last_accessed=db.bindparam('hit_time'))
+        params = [{'hit_key': key, 'hit_count': count, 'hit_time': last}
+                  for key, count, last in hits]
+        with db.engine.begin() as connection:
+            connection.execute(statement, params)
+
+    @classmethod
+    def trim(cls, source_data_md5, max_bytes, policy='lru'):
+        """Remove stale records, then evict records beyond the byte budget.
+
+        Args:
+            source_data_md5 (str): The md5 of the current source data.
+                Records made from other data are removed.
+            max_bytes (int): Budget for the total size of the records.
+            policy (str): 'lru' evicts the least recently accessed records
+                first, 'lfu' the least hit.
+
+        Returns:
+            int: Number of records removed.
+        """
+        orders = {
+            'lru': (cls.last_accessed,),
+            'lfu': (cls.hits, cls.last_accessed)
+        }
+        if policy not in orders:
+            raise ValueError('Unknown cache eviction policy: ' + policy)
+        cls.flush_hits()
+        removed = cls.query.filter(db.or_(
+            cls.source_data_md5 != source_data_md5,
+            cls.source_data_md5.is_(None)
+        )).delete(synchronize_session=False)
+        excess = (db.session.query(db.func.sum(cls.size)).scalar() or 0) \
+            - max_bytes
+        evicted = []
+        if excess > 0:
+            for key, size in db.session.query(cls.key, cls.size)\
+                    .order_by(*orders[policy]):
+                if excess <= 0:
+                    break
+                evicted.append(key)
+                excess -= size
+        chunk_size = 500
+        for i in range(0, len(evicted), chunk_size):
+            cls.query.filter(cls.key.in_(evicted[i:i + chunk_size]))\
+                .delete(synchronize_session=False)
+        db.session.commit()
+        return removed + len(evicted)
+
+    @classmethod
+    def stats(cls, source_data_md5, top=10):
+        """Summarize the use of the cache table.
+
+        Args:
+            source_data_md5 (str): The md5 of the current source data.
+            top (int): Number of records to list by most and fewest hits.
+
+        Returns:
+            dict: Counts and sizes of all, stale, and never hit records, and
+            (key, hits, size, last accessed) of the most and least hit
+            current records.
+        """
+        def summary(*criteria):
+            """Return count, size and hits of the matching records."""
+            count, size, hits = db.session.query(
+                db.func.count(cls.key), db.func.sum(cls.size),
+                db.func.sum(cls.hits)).filter(*criteria).one()
+            return {'records': count, 'bytes': size or 0, 'hits': hits or 0}
+        current = cls.source_data_md5 == source_data_md5
+        listed = db.session.query(cls.key, cls.hits, cls.size,
+                                  cls.last_accessed).filter(current)
+        most_hit = listed.order_by(cls.hits.desc(), cls.key).limit(top)
+        least_hit = listed.order_by(cls.hits, cls.size.desc()).limit(top)
+        return {
+            'all': summary(),
+            'stale': summary(db.or_(~current, cls.source_data_md5.is_(None))),
+            'never_hit': summary(current, cls.hits == 0),
+            'most_hit': most_hit.all(),
+            'least_hit': least_hit.all()
+        }
+
+    def compress(self, body):
+        """Store a response body in every available encoding.
+
+        The gzip header has no timestamp, so the same body always gives the
+        same bytes.
+
+        Args:
+            body (bytes): The uncompressed response body.
+        """
+        buffer = BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as gzip_file:
+            gzip_file.write(body)
+        self.value_gzip = buffer.getvalue()
+        self.value_brotli = None
+        if brotli is not None:
+            self.value_brotli = brotli.compress(body,
+                                                quality=self.brotli_quality)
+        self.size = len(self.value_gzip) + len(self.value_brotli or b'')
+
+    def to_response(self):
+        """Return the cached response in an encoding the client accepts.
+
+        Brotli is preferred over gzip. For clients that accept neither, the
+        body is decompressed.
+
+        Returns:
+            Response: The response for the current request.
+        """
+        accepted = request.accept_encodings
+        encoding = None
+        if self.value_brotli is not None and accepted['br']:
+            body, encoding = self.value_brotli, 'br'
+        elif accepted['gzip']:
+            body, encoding = self.value_gzip, 'gzip'
+        else:
+            body = gzip.decompress(self.value_gzip)
+        response = Response(body, mimetype=self.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def detached_copy(self):
+        """Return a copy of this record that belongs to no session."""
+        return Cache(key=self.key, value_gzip=self.value_gzip,
+                     value_brotli=self.value_brotli, mimetype=self.mimetype,
+                     source_data_md5=self.source_data_md5, size=self.size)
+
+    def keep_local(self):
+        """Put this record into the in-process cache of the application."""
+        current_app.local_cache.put(self.key, self, self.size)
+
     def __repr__(self):
         """Give a representation of this record."""
         return "<Cache key='{}'>".format(self.key)
 
 
+_CACHE_HITS = HitTally()
+
+
 class Indicator(ApiModel):
     """Indicator model."""
 
@@ -263,14 +657,26 @@ class Indicator(ApiModel):
         parameter names to model field names, (2) Reformats any empty strings,
         and (3) Calls super init.
         """
-        kwargs['is_favorite'] = bool(kwargs['is_favorite'])
-        self.update_kwargs_english(kwargs, 'level1', 'level1_id')
-        self.update_kwargs_english(kwargs, 'level2', 'level2_id')
-        self.update_kwargs_english(kwargs, 'domain', 'domain_id')
-        self.update_kwargs_english(kwargs, 'definition', 'definition_id')
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
+        self.prepare(kwargs)
         super(Indicator, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        kwargs['is_favorite'] = bool(kwargs['is_favorite'])
+        cls.update_kwargs_english(kwargs, 'level1', 'level1_id', lookup)
+        cls.update_kwargs_english(kwargs, 'level2', 'level2_id', lookup)
+        cls.update_kwargs_english(kwargs, 'domain', 'domain_id', lookup)
+        cls.update_kwargs_english(kwargs, 'definition', 'definition_id',
+                                  lookup)
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        return cls.joined(via, cls.label, cls.definition, cls.level1,
+                          cls.level2, cls.domain)
+
     def full_json(self, lang=None, jns=False, endpoint=None):
         """Return dictionary ready to convert to JSON as response.
 
@@ -354,11 +760,22 @@ class CharacteristicGroup(ApiModel):
         values into the EnglishString translation table if not present, and
         (4) calls super init.
         """
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
-        self.update_kwargs_english(kwargs, 'definition', 'definition_id')
-        self.update_kwargs_english(kwargs, 'category', 'category_id')
+        self.prepare(kwargs)
         super(CharacteristicGroup, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+        cls.update_kwargs_english(kwargs, 'definition', 'definition_id',
+                                  lookup)
+        cls.update_kwargs_english(kwargs, 'category', 'category_id', lookup)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        return cls.joined(via, cls.label, cls.definition)
+
     def full_json(self, lang=None, jns=False, index=None):
         """Return dictionary ready to convert to JSON as response.
 
@@ -445,11 +862,23 @@ class Characteristic(ApiModel):
         Raises:
             AttributeError: If valid ID is not found for CharacteristicGroup.
         """
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
-        self.set_kwargs_id(kwargs, 'char_grp_code', 'char_grp_id',
-                           CharacteristicGroup)
+        self.prepare(kwargs)
         super(Characteristic, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+        cls.set_kwargs_id(kwargs, 'char_grp_code', 'char_grp_id',
+                          CharacteristicGroup, lookup=lookup)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        to_char_grp = cls.joined(via, cls.char_grp)
+        return cls.joined(via, cls.label) + to_char_grp + \
+            CharacteristicGroup.full_json_loaders(to_char_grp[0])
+
     def full_json(self, lang=None, jns=False, index=None):
         """Return dictionary ready to convert to JSON as response.
 
@@ -530,6 +959,7 @@ class Data(ApiModel):
     """Data model."""
 
     __tablename__ = 'datum'
+    natural_key = ('survey_id', 'indicator_id', 'char1_id', 'char2_id')
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String, unique=True)
     value = db.Column(db.Float, nullable=False)
@@ -558,21 +988,45 @@ class Data(ApiModel):
 
         Does a few things: (1) Updates instance based on mapping from API query
         parameter names to model field names, (2) Reformats any empty strings,
-        (3) Sets a randomly generated code string, and (4) Calls super init.
+        (3) Sets a code string derived from the survey, indicator and
+        characteristics, and (4) Calls super init.
         """
         if kwargs:
-            kwargs['is_total'] = bool(kwargs['is_total'])
-            self.set_kwargs_id(kwargs, 'survey_code', 'survey_id', Survey)
-            self.set_kwargs_id(kwargs, 'indicator_code', 'indicator_id',
-                               Indicator)
-            self.set_kwargs_id(kwargs, 'char1_code', 'char1_id',
-                               Characteristic, False)
-            self.set_kwargs_id(kwargs, 'char2_code', 'char2_id',
-                               Characteristic, False)
-            self.empty_to_none(kwargs)
-            kwargs['code'] = next64()
+            self.prepare(kwargs)
             super(Data, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        kwargs['code'] = hash64(kwargs['survey_code'],
+                                kwargs['indicator_code'],
+                                kwargs['char1_code'], kwargs['char2_code'])
+        kwargs['is_total'] = bool(kwargs['is_total'])
+        cls.set_kwargs_id(kwargs, 'survey_code', 'survey_id', Survey,
+                          lookup=lookup)
+        cls.set_kwargs_id(kwargs, 'indicator_code', 'indicator_id',
+                          Indicator, lookup=lookup)
+        cls.set_kwargs_id(kwargs, 'char1_code', 'char1_id', Characteristic,
+                          False, lookup)
+        cls.set_kwargs_id(kwargs, 'char2_code', 'char2_id', Characteristic,
+                          False, lookup)
+        cls.empty_to_none(kwargs)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        options = cls.joined(via, cls.geo)
+        related = (
+            (cls.survey, Survey),
+            (cls.indicator, Indicator),
+            (cls.char1, Characteristic),
+            (cls.char2, Characteristic)
+        )
+        for attr, model in related:
+            to_related = cls.joined(via, attr)
+            options += to_related + model.full_json_loaders(to_related[0])
+        return options
+
     def full_json(self, lang=None, jns=False):
         """Return dictionary ready to convert to JSON as response.
 
@@ -721,16 +1175,27 @@ class Survey(ApiModel):
         Raises:
             AttributeError: If valid ID is not found for Country.
         """
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
-        self.update_kwargs_english(kwargs, 'partner', 'partner_id')
-        self.update_kwargs_date(kwargs, 'start_date', '%m-%Y')
-        self.update_kwargs_date(kwargs, 'end_date', '%m-%Y')
-        self.set_kwargs_id(kwargs, 'country_code', 'country_id', Country,
-                           required=True)
-        self.set_kwargs_id(kwargs, 'geography_code', 'geography_id', Geography,
-                           required=False)
+        self.prepare(kwargs)
         super(Survey, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+        cls.update_kwargs_english(kwargs, 'partner', 'partner_id', lookup)
+        cls.update_kwargs_date(kwargs, 'start_date', '%m-%Y')
+        cls.update_kwargs_date(kwargs, 'end_date', '%m-%Y')
+        cls.set_kwargs_id(kwargs, 'country_code', 'country_id', Country,
+                          required=True, lookup=lookup)
+        cls.set_kwargs_id(kwargs, 'geography_code', 'geography_id', Geography,
+                          required=False, lookup=lookup)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        to_country = cls.joined(via, cls.country)
+        return to_country + Country.full_json_loaders(to_country[0])
+
     def __repr__(self):
         """Return a representation of this object."""
         return '<Survey "{}">'.format(self.code)
@@ -804,9 +1269,19 @@ class Country(ApiModel):
         Does a few things: (1) Updates instance based on mapping from API query
         parameter names to model field names, and (2) calls super init.
         """
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
+        self.prepare(kwargs)
         super(Country, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+
+    @classmethod
+    def full_json_loaders(cls, via=None):
+        """Return loader options for the relationships read by full_json."""
+        return cls.joined(via, cls.label)
+
     @staticmethod
     def validate_param_types(request_args):
         """Validate query parameter types.
@@ -967,12 +1442,9 @@ class Country(ApiModel):
         if lang is None or lang.lower() == 'en':
             json_obj['label'] = self.label.english
         else:
-            lang = lang.lower()
-            translations = self.label.translations
-            gen = iter(t for t in translations if t.language_code == lang)
-            translation = next(gen, None)
+            translation = Translation.get_texts(lang).get(self.label_id)
             if translation:
-                json_obj['label'] = translation.translation
+                json_obj['label'] = translation
             else:
                 json_obj['label'] = url_for(
                     'api.get_text', code=self.label.code, _external=True)
@@ -1005,10 +1477,16 @@ class Geography(ApiModel):
         Does a few things: (1) Updates instance based on mapping from API query
         parameter names to model field names, and (2) calls super init.
         """
-        self.update_kwargs_english(kwargs, 'label', 'label_id')
-        self.update_kwargs_english(kwargs, 'subheading', 'subheading_id')
+        self.prepare(kwargs)
         super(Geography, self).__init__(**kwargs)
 
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        cls.update_kwargs_english(kwargs, 'label', 'label_id', lookup)
+        cls.update_kwargs_english(kwargs, 'subheading', 'subheading_id',
+                                  lookup)
+
     @staticmethod
     def none_json(jns=False):
         """Return dictionary ready to convert to JSON as response.
@@ -1042,7 +1520,7 @@ class EnglishString(ApiModel):
     __tablename__ = 'english_string'
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String, unique=True)
-    english = db.Column(db.String, nullable=False)
+    english = db.Column(db.String, nullable=False, index=True)
     translations = db.relationship('Translation')
 
     def to_string(self, lang=None):
@@ -1056,11 +1534,8 @@ class EnglishString(ApiModel):
         """
         result = self.english
         if lang is not None and lang.lower() != 'en':
-            lang = lang.lower()
-            gen = iter(t for t in self.translations if t.language_code == lang)
-            found = next(gen, None)
-            if found is not None:
-                result = found.translation
+            texts = Translation.get_texts(lang)
+            result = texts.get(self.id, result)
         return result
 
     def to_json(self):
@@ -1126,8 +1601,9 @@ class EnglishString(ApiModel):
         this_dict = {
             'en': self.english
         }
-        for translation in self.translations:
-            this_dict[translation.language_code] = translation.translation
+        for lang, texts in Translation.get_lookup().items():
+            if self.id in texts:
+                this_dict[lang] = texts[self.id]
         to_return = {
             self.code: this_dict
         }
@@ -1146,6 +1622,7 @@ class Translation(ApiModel):
     """Translation model."""
 
     __tablename__ = 'translation'
+    natural_key = ('english_id', 'language_code')
     id = db.Column(db.Integer, primary_key=True)
     english_id = db.Column(db.Integer, db.ForeignKey('english_string.id'))
     language_code = db.Column(db.String, nullable=False)
@@ -1173,16 +1650,74 @@ class Translation(ApiModel):
         record for UI data. Otherwise, gets the english code and (2) Calls
         super init.
         """
-        if kwargs.get('english_code'):
-            english = EnglishString.insert_or_update(
-                kwargs['english'], kwargs['english_code'].lower())
-            kwargs.pop('english_code')
+        self.prepare(kwargs)
+        super(Translation, self).__init__(**kwargs)
+
+    @classmethod
+    def prepare(cls, kwargs, lookup=None):
+        """Convert the fields of a row of source data to model fields."""
+        english_code = kwargs.pop('english_code', None)
+        if english_code and lookup is not None:
+            english_id = lookup.english_code_id(kwargs['english'],
+                                                english_code.lower())
+        elif english_code:
+            english_id = EnglishString.insert_or_update(
+                kwargs['english'], english_code.lower()).id
+        elif lookup is not None:
+            english_id = lookup.english_id(kwargs['english'], create=False)
         else:
-            english = EnglishString.query.filter_by(english=kwargs['english'])\
-                .first()
-        kwargs['english_id'] = english.id
+            english_id = EnglishString.query\
+                .filter_by(english=kwargs['english']).first().id
+        kwargs['english_id'] = english_id
         kwargs.pop('english')
-        super(Translation, self).__init__(**kwargs)
+
+    @staticmethod
+    def get_lookup():
+        """Return all translations, grouped by language.
+
+        The lookup is built once per process and rebuilt only when source data
+        is reloaded. It is read-only and shared by all serializers.
+
+        Returns:
+            Mapping: Language code to a mapping of EnglishString id to the
+            translated text. If there are several translations of a string in
+            the same language, the first one is used.
+        """
+        return _TRANSLATIONS.get(SourceData.get_version())
+
+    @staticmethod
+    def get_texts(lang):
+        """Return the translations into one language.
+
+        Args:
+            lang (str): The language code.
+
+        Returns:
+            Mapping: EnglishString id to the translated text.
+        """
+        return Translation.get_lookup().get(lang.lower(), _NO_TEXTS)
+
+    @staticmethod
+    def build_lookup(key):
+        # pylint: disable=unused-argument
+        """Build all translations, grouped by language.
+
+        Args:
+            key (tuple): Version of the source data.
+
+        Returns:
+            Mapping: See get_lookup.
+        """
+        lookup = {}
+        records = db.session.query(Translation.language_code,
+                                   Translation.english_id,
+                                   Translation.translation)\
+            .order_by(Translation.id)
+        for lang, english_id, text in records:
+            lookup.setdefault(lang, {}).setdefault(english_id, text)
+        return MappingProxyType({
+            lang: MappingProxyType(texts) for lang, texts in lookup.items()
+        })
 
     @staticmethod
     def languages():
@@ -1198,3 +1733,7 @@ class Translation(ApiModel):
         else:
             preview = self.translation
         return '<Translation ({}) "{}">'.format(self.language_code, preview)
+
+
+_NO_TEXTS = MappingProxyType({})
+_TRANSLATIONS = DatasetMemo(Translation.build_lookup)
@@ -1,12 +1,15 @@
 """Queries."""
 from collections import ChainMap
 
-from sqlalchemy import or_
+from sqlalchemy import func, or_
 from sqlalchemy.orm import aliased
 
 from . import db
+from .cube import DatalabCube
+from .facets import FacetIndex
 from .models import (Characteristic, CharacteristicGroup, Country, Data,
                      EnglishString, Geography, Indicator, Survey, Translation)
+from .utils import coalesced
 
 
 # pylint: disable=too-many-public-methods
@@ -17,6 +20,12 @@ class DatalabData:
     char2 = aliased(Characteristic)
     char_grp1 = aliased(CharacteristicGroup)
     char_grp2 = aliased(CharacteristicGroup)
+    survey_label = aliased(EnglishString)
+    indicator_label = aliased(EnglishString)
+    char_grp1_label = aliased(EnglishString)
+    char1_label = aliased(EnglishString)
+    geo_label = aliased(EnglishString)
+    country_label = aliased(EnglishString)
 
     @staticmethod
     def all_joined(*select_args):
@@ -40,8 +49,9 @@ class DatalabData:
     @staticmethod
     def series_query(survey_codes, indicator_code, char_grp_code, over_time):
         """Get the series based on supplied codes."""
-        json_list = DatalabData.filter_minimal(survey_codes, indicator_code,
-                                               char_grp_code, over_time)
+        shared = DatalabData.filter_minimal(survey_codes, indicator_code,
+                                            char_grp_code, over_time)
+        json_list = [dict(item) for item in shared]
         if over_time:
             series_list = DatalabData.data_to_time_series(json_list)
         else:
@@ -130,59 +140,178 @@ class DatalabData:
         return results
 
     @staticmethod
-    def filter_readable(survey_codes, indicator_code, char_grp_code,
-                        lang=None):
-        """Get filtered Datalab data and return readable columns.
+    def nulls_first(column):
+        """Order by a column ascending, with NULL first on any database.
+
+        SQLite sorts NULL first already, and older versions do not support
+        NULLS FIRST. PostgreSQL sorts NULL last unless told otherwise.
+
+        Args:
+            column: SqlAlchemy column.
+
+        Returns:
+            The ORDER BY expression.
+        """
+        if db.engine.dialect.name == 'sqlite':
+            return column
+        return column.nullsfirst()
+
+    @staticmethod
+    def minimal_joined():
+        """Datalab data joined with the label codes of minimal data.
+
+        Returns:
+            A query of plain columns. In order, these are data value, data
+            precision, survey code, survey label code, survey start date,
+            survey order, indicator code, characteristic group code,
+            characteristic code, characteristic label code, characteristic
+            order, geography code, geography label code, geography order,
+            country code, and country label code.
+        """
+        chr1, grp1 = DatalabData.char1, DatalabData.char_grp1
+        survey_label = DatalabData.survey_label
+        char1_label = DatalabData.char1_label
+        geo_label = DatalabData.geo_label
+        country_label = DatalabData.country_label
+        select_args = (Data.value, Data.precision,
+                       Survey.code, survey_label.code, Survey.start_date,
+                       Survey.order, Indicator.code, grp1.code,
+                       chr1.code, char1_label.code, chr1.order,
+                       Geography.code, geo_label.code, Geography.order,
+                       Country.code, country_label.code)
+        joined = DatalabData.all_joined(*select_args) \
+            .outerjoin(survey_label, Survey.label_id == survey_label.id) \
+            .outerjoin(char1_label, chr1.label_id == char1_label.id) \
+            .outerjoin(geo_label, Geography.subheading_id == geo_label.id) \
+            .outerjoin(country_label, Country.label_id == country_label.id)
+        return joined
+
+    @staticmethod
+    def readable_joined(lang=None):
+        """Datalab data joined with the label text of readable data.
+
+        Labels are translated if a language other than English is supplied.
+        A label without translation falls back to English, and if there are
+        several translations, the first one is used.
+
+        Args:
+            lang (str): The language, if specified.
+
+        Returns:
+            A query of plain columns. In order, these are data value, data
+            precision, survey code, survey start date, indicator label,
+            characteristic group label, and characteristic label.
+        """
+        labels = (
+            (DatalabData.indicator_label, Indicator.label_id),
+            (DatalabData.char_grp1_label, DatalabData.char_grp1.label_id),
+            (DatalabData.char1_label, DatalabData.char1.label_id)
+        )
+        translations = None
+        if lang is not None and lang.lower() != 'en':
+            first = db.session.query(func.min(Translation.id)) \
+                .filter(Translation.language_code == lang.lower()) \
+                .group_by(Translation.english_id)
+            translations = db.session.query(Translation.english_id,
+                                            Translation.translation) \
+                .filter(Translation.id.in_(first)).subquery()
+        select_args = (Data.value, Data.precision, Survey.code,
+                       Survey.start_date)
+        joined = DatalabData.all_joined(*select_args)
+        for label, label_id in labels:
+            joined = joined.outerjoin(label, label_id == label.id)
+            if translations is None:
+                joined = joined.add_columns(label.english)
+            else:
+                translated = translations.alias()
+                joined = joined \
+                    .outerjoin(translated,
+                               translated.c.english_id == label.id) \
+                    .add_columns(func.coalesce(translated.c.translation,
+                                               label.english))
+        return joined
+
+    @staticmethod
+    def filtered(query, survey_codes, indicator_code, char_grp_code):
+        """Filter joined datalab data.
 
         Args:
+            query: A query built on DatalabData.all_joined.
             survey_codes (str): A list of survey codes joined together by a
                 comma
             indicator_code (str): An indicator code
             char_grp_code (str): A characteristic group code
-            lang (str): The language, if specified.
-
-        Filters the data based on the function arguments.
 
         Returns:
-            A list of simple python objects, one for each record found by
-            applying the various filters.
+            The filtered query.
         """
-        chr1 = DatalabData.char1
         grp1, grp2 = DatalabData.char_grp1, DatalabData.char_grp2
-        select_args = (Data, Survey, Indicator, grp1, chr1)
-        filtered = DatalabData.all_joined(*select_args)
         if survey_codes is not None:
             survey_sql = DatalabData.survey_list_to_sql(survey_codes)
-            filtered = filtered.filter(survey_sql)
+            query = query.filter(survey_sql)
         if indicator_code is not None:
-            filtered = filtered.filter(Indicator.code == indicator_code)
+            query = query.filter(Indicator.code == indicator_code)
         if char_grp_code is not None:
-            filtered = filtered.filter(grp1.code == char_grp_code)
+            query = query.filter(grp1.code == char_grp_code)
         # TODO (jkp, begin=2017-08-28): This will be grp2.code == 'none'
         # eventually when the Data show "none" for char_grp2 in excel import
         # Remove E711 from .pycodestyle
         # pylint: disable=singleton-comparison
-        filtered = filtered.filter(grp2.code == None)
-        results = filtered.all()
-        json_results = []
-        for item in results:
-            precision = item[0].precision
-            if precision is None:
-                precision = 1
-            value = round(item[0].value, precision)
-            this_dict = {
-                'value': value,
-                'survey.id': item[1].code,
-                'survey.date': item[1].start_date.strftime('%m-%Y'),
-                'indicator.label': item[2].label.to_string(lang),
-                'characteristicGroup.label': item[3].label.to_string(lang),
-                'characteristic.label': item[4].label.to_string(lang)
-            }
-            json_results.append(this_dict)
+        query = query.filter(grp2.code == None)
+        return query
+
+    @staticmethod
+    @coalesced
+    def filter_readable(survey_codes, indicator_code, char_grp_code,
+                        lang=None):
+        """Get filtered Datalab data and return readable columns.
+
+        Args:
+            survey_codes (str): A list of survey codes joined together by a
+                comma
+            indicator_code (str): An indicator code
+            char_grp_code (str): A characteristic group code
+            lang (str): The language, if specified.
+
+        Filters the data based on the function arguments. All labels are
+        resolved in the same SQL statement.
+
+        Returns:
+            A list of simple python objects, one for each record found by
+            applying the various filters.
+        """
+        joined = DatalabData.readable_joined(lang)
+        filtered = DatalabData.filtered(joined, survey_codes, indicator_code,
+                                        char_grp_code)
+        results = db.session.execute(filtered.with_labels().statement)
+        json_results = [DatalabData.readable_record(item) for item in results]
         return json_results
 
+    @staticmethod
+    def readable_record(item):
+        """Convert a row of DatalabData.readable_joined to a record.
+
+        Args:
+            item: The row.
+
+        Returns:
+            dict: Value rounded to its precision, and readable columns.
+        """
+        precision = item[1]
+        if precision is None:
+            precision = 1
+        value = round(item[0], precision)
+        return {
+            'value': value,
+            'survey.id': item[2],
+            'survey.date': item[3].strftime('%m-%Y'),
+            'indicator.label': item[4],
+            'characteristicGroup.label': item[5],
+            'characteristic.label': item[6]
+        }
 
     @staticmethod
+    @coalesced
     def filter_minimal(survey_codes, indicator_code, char_grp_code, over_time):
         """Get filtered Datalab data and return minimal columns.
 
@@ -196,53 +325,54 @@ class DatalabData:
         are data value, the precision, the survey code, the indicator code,
         the characteristic group code, and the characteristic code.
 
+        If the datalab cube is enabled, the data are served from memory
+        instead of from the database. Otherwise, all label codes are resolved
+        in the same SQL statement.
+
+        Identical calls running at the same time share one result, so callers
+        must copy the records before changing them.
+
         Returns:
             A list of simple python objects, one for each record found by
             applying the various filters.
         """
+        if DatalabCube.enabled():
+            cube = DatalabCube.current()
+            return cube.filter_minimal(survey_codes, indicator_code,
+                                       char_grp_code, over_time)
         chr1 = DatalabData.char1
-        grp1, grp2 = DatalabData.char_grp1, DatalabData.char_grp2
-        select_args = (Data, Survey, Indicator.code, grp1.code, chr1,
-                       Geography, Country)
-        filtered = DatalabData.all_joined(*select_args)
-        if survey_codes is not None:
-            survey_sql = DatalabData.survey_list_to_sql(survey_codes)
-            filtered = filtered.filter(survey_sql)
-        if indicator_code is not None:
-            filtered = filtered.filter(Indicator.code == indicator_code)
-        if char_grp_code is not None:
-            filtered = filtered.filter(grp1.code == char_grp_code)
-        # TODO (jkp, begin=2017-08-28): This will be grp2.code == 'none'
-        # eventually when the Data show "none" for char_grp2 in excel import
-        # Remove E711 from .pycodestyle
-        # pylint: disable=singleton-comparison
-        filtered = filtered.filter(grp2.code == None)
+        joined = DatalabData.minimal_joined()
+        filtered = DatalabData.filtered(joined, survey_codes, indicator_code,
+                                        char_grp_code)
+        nulls_first = DatalabData.nulls_first
         if over_time:
             # This ordering is very important!
-            ordered = filtered.order_by(Geography.order) \
-                              .order_by(chr1.order) \
-                              .order_by(Survey.order)
+            ordered = filtered.order_by(nulls_first(Geography.order)) \
+                              .order_by(nulls_first(chr1.order)) \
+                              .order_by(nulls_first(Survey.order))
             # Perhaps order by the date of the survey?
         else:
-            ordered = filtered.order_by(Survey.order) \
-                              .order_by(chr1.order)
-        results = ordered.all()
+            ordered = filtered.order_by(nulls_first(Survey.order)) \
+                              .order_by(nulls_first(chr1.order))
+        # Ties are in id order, as in the cube.
+        ordered = ordered.order_by(Data.id)
+        results = db.session.execute(ordered.with_labels().statement)
         json_results = []
         for item in results:
             this_dict = {
-                'value': item[0].value,
-                'precision': item[0].precision,
-                'survey.id': item[1].code,
-                'survey.date': item[1].start_date.strftime('%m-%Y'),
-                'survey.label.id': item[1].label.code,
-                'indicator.id': item[2],
-                'characteristicGroup.id': item[3],
-                'characteristic.id': item[4].code,
-                'characteristic.label.id': item[4].label.code,
-                'geography.label.id': item[5].subheading.code,
-                'geography.id': item[5].code,
-                'country.label.id': item[6].label.code,
-                'country.id': item[6].code
+                'value': item[0],
+                'precision': item[1],
+                'survey.id': item[2],
+                'survey.date': item[4].strftime('%m-%Y'),
+                'survey.label.id': item[3],
+                'indicator.id': item[6],
+                'characteristicGroup.id': item[7],
+                'characteristic.id': item[8],
+                'characteristic.label.id': item[9],
+                'geography.label.id': item[12],
+                'geography.id': item[11],
+                'country.label.id': item[15],
+                'country.id': item[14]
             }
             json_results.append(this_dict)
         return json_results
@@ -280,8 +410,8 @@ class DatalabData:
         return full_sql
 
     @staticmethod
+    @coalesced
     def combos_all(survey_list, indicator, char_grp):
-        # pylint: disable=too-many-locals
         """Get lists of all valid datalab selections.
 
         Based on a current selection in the datalab, this method returns lists
@@ -299,100 +429,25 @@ class DatalabData:
             A dictionary with a survey list, an indicator list, and a
             characteristic group list.
         """
-        def keep_survey(this_indicator, this_char_grp):
-            """Determine whether a survey from the data is valid.
-
-            Args:
-                this_indicator (str): An indicator code from the data
-                this_char_grp (str): A characteristic code from the data
-
-            Returns:
-                True or False to say if the related survey code should be
-                included in the return set.
-            """
-            if indicator is None and char_grp is None:
-                keep = True
-            elif indicator is None and char_grp is not None:
-                keep = this_char_grp == char_grp
-            elif indicator is not None and char_grp is None:
-                keep = this_indicator == indicator
-            else:
-                indicator_match = this_indicator == indicator
-                char_grp_match = this_char_grp == char_grp
-                keep = indicator_match and char_grp_match
-            return keep
-
-        def keep_indicator(this_survey, this_char_grp):
-            """Determine whether an indicator from the data is valid.
-
-            Args:
-                this_survey (str): A survey code from the data
-                this_char_grp (str): A characteristic code from the data
-
-            Returns:
-                True or False to say if the related indicator code should be
-                included in the return set.
-            """
-            if not survey_list and char_grp is None:
-                keep = True
-            elif not survey_list and char_grp is not None:
-                keep = this_char_grp == char_grp
-            elif survey_list and char_grp is None:
-                keep = this_survey in survey_list
-            else:
-                survey_match = this_survey in survey_list
-                char_grp_match = this_char_grp == char_grp
-                keep = survey_match and char_grp_match
-            return keep
-
-        def keep_char_grp(this_survey, this_indicator):
-            """Determine whether a characterist group from the data is valid.
-
-            Args:
-                this_survey (str): A survey code from the data
-                this_indicator (str): An indicator code from the data
-
-            Returns:
-                True or False to say if the related characteristic group code
-                should be included in the return set.
-            """
-            if not survey_list and indicator is None:
-                keep = True
-            elif not survey_list and indicator is not None:
-                keep = this_indicator == indicator
-            elif survey_list and indicator is None:
-                keep = this_survey in survey_list
-            else:
-                survey_match = this_survey in survey_list
-                indicator_match = this_indicator == indicator
-                keep = survey_match and indicator_match
-            return keep
-
-        select_args = (Survey.code, Indicator.code, DatalabData.char_grp1.code)
-        joined = DatalabData.all_joined(*select_args)
-        results = joined.distinct().all()
-        surveys = set()
-        indicators = set()
-        char_grps = set()
-        for survey_code, indicator_code, char_grp_code in results:
-            if keep_survey(indicator_code, char_grp_code):
-                surveys.add(survey_code)
-            if keep_indicator(survey_code, char_grp_code):
-                indicators.add(indicator_code)
-            if keep_char_grp(survey_code, indicator_code):
-                char_grps.add(char_grp_code)
+        facets = FacetIndex.current()
+        surveys, indicators, char_grps = \
+            facets.combos(survey_list, indicator, char_grp)
         json_obj = {
-            'survey.id': sorted(list(surveys)),
-            'indicator.id': sorted(list(indicators)),
-            'characteristicGroup.id': sorted(list(char_grps))
+            'survey.id': surveys,
+            'indicator.id': indicators,
+            'characteristicGroup.id': char_grps
         }
         return json_obj
 
     @staticmethod
     def all_minimal():
-        """Get all datalab data in the minimal style."""
+        """Get all datalab data in the minimal style.
+
+        The list is a copy, since the result of filter_minimal may be shared
+        with identical calls.
+        """
         results = DatalabData.filter_minimal(None, None, None, False)
-        return results
+        return list(results)
 
     @staticmethod
     def combos_indicator(indicator):
@@ -404,20 +459,11 @@ class DatalabData:
         Returns:
             A dictionary with two key names and list values.
         """
-        select_args = (Survey.code, DatalabData.char_grp1.code)
-        joined = DatalabData.all_joined(*select_args)
-        filtered = joined.filter(Indicator.code == indicator)
-        results = filtered.distinct().all()
-        survey_codes = set()
-        char_grp_codes = set()
-        for item in results:
-            survey_code = item[0]
-            survey_codes.add(survey_code)
-            char_grp_code = item[1]
-            char_grp_codes.add(char_grp_code)
+        facets = FacetIndex.current()
+        surveys, _, char_grps = facets.combos(indicator=indicator)
         to_return = {
-            'survey.id': sorted(list(survey_codes)),
-            'characteristicGroup.id': sorted(list(char_grp_codes))
+            'survey.id': surveys,
+            'characteristicGroup.id': char_grps
         }
         return to_return
 
@@ -431,26 +477,16 @@ class DatalabData:
         Returns:
             A dictionary with two key names and list values.
         """
-        select_args = (Survey.code, Indicator.code)
-        joined = DatalabData.all_joined(*select_args)
-        filtered = joined.filter(DatalabData.char_grp1.code == char_grp_code)
-        results = filtered.distinct().all()
-        survey_codes = set()
-        indicator_codes = set()
-        for item in results:
-            survey_code = item[0]
-            survey_codes.add(survey_code)
-            indicator_code = item[1]
-            indicator_codes.add(indicator_code)
+        facets = FacetIndex.current()
+        surveys, indicators, _ = facets.combos(char_grp=char_grp_code)
         to_return = {
-            'survey.id': sorted(list(survey_codes)),
-            'indicator.id': sorted(list(indicator_codes))
+            'survey.id': surveys,
+            'indicator.id': indicators
         }
         return to_return
 
     @staticmethod
     def combos_survey_list(survey_list):
-        # TODO (jkp 2017-08-29): make better. make hashmaps one to the other
         """Get all valid combos of indicator and characteristic groups.
 
         Args:
@@ -459,33 +495,12 @@ class DatalabData:
         Returns:
             An object.
         """
-        select_args = (Indicator.code, DatalabData.char_grp1.code)
-        joined = DatalabData.all_joined(*select_args)
-        survey_list_sql = DatalabData.survey_list_to_sql(survey_list)
-        filtered = joined.filter(survey_list_sql)
-        results = filtered.distinct().all()
-        indicator_dict = {}
-        char_grp_dict = {}
-        for item in results:
-            this_indicator = item[0]
-            this_char_grp = item[1]
-            if this_indicator in indicator_dict:
-                indicator_dict[this_indicator].add(this_char_grp)
-            else:
-                indicator_dict[this_indicator] = set([this_char_grp])
-            if this_char_grp in char_grp_dict:
-                char_grp_dict[this_char_grp].add(this_indicator)
-            else:
-                char_grp_dict[this_char_grp] = set([this_indicator])
-        new_indicator_dict = {
-            k: sorted(list(v)) for k, v in indicator_dict.items()
-        }
-        new_char_grp_dict = {
-            k: sorted(list(v)) for k, v in char_grp_dict.items()
-        }
+        facets = FacetIndex.current()
+        indicator_dict, char_grp_dict = \
+            facets.co_occurring(survey_list.split(','))
         to_return = {
-            'indicators': new_indicator_dict,
-            'characteristicGroups': new_char_grp_dict
+            'indicators': indicator_dict,
+            'characteristicGroups': char_grp_dict
         }
         return to_return
 
@@ -501,13 +516,11 @@ class DatalabData:
             A list of surveys that have data for the supplied indicator and
             characteristic group
         """
-        select_arg = Survey.code
-        joined = DatalabData.all_joined(select_arg)
-        filtered = joined.filter(Indicator.code == indicator_code) \
-            .filter(DatalabData.char_grp1.code == char_grp_code)
-        results = filtered.distinct().all()
+        facets = FacetIndex.current()
+        surveys, _, _ = facets.combos(indicator=indicator_code,
+                                      char_grp=char_grp_code)
         to_return = {
-            'survey.id': [item[0] for item in results]
+            'survey.id': surveys
         }
         return to_return
 
@@ -634,6 +647,7 @@ class DatalabData:
         return Translation.languages()
 
     @staticmethod
+    @coalesced
     def datalab_init():
         """Datalab Init."""
         return {
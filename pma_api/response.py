@@ -1,12 +1,30 @@
 """Responses."""
 from io import StringIO
+from itertools import chain
 from csv import DictWriter
 
-from flask import Response, jsonify, make_response
+from flask import Response, current_app, make_response, request, \
+    stream_with_context
 
 from .__version__ import __version__
 
 
+def encode_json(obj):
+    """Make a JSON response like jsonify, with the app's JSON encoder.
+
+    Args:
+        obj: The object to encode.
+
+    Returns:
+        Response: The response, with the encoded bytes as its body.
+    """
+    pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and \
+        not request.is_xhr
+    body = current_app.json_backend.dumps(obj, pretty)
+    return current_app.response_class(
+        (body, b'\n'), mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
 class ApiResult:
     """A representation of a generic JSON API result."""
 
@@ -30,7 +48,7 @@ class ApiResult:
             **self.kwargs,
             'metadata': metadata
         }
-        return jsonify(obj)
+        return encode_json(obj)
 
     @staticmethod
     def metadata(extra_metadata=None):
@@ -38,8 +56,7 @@ class ApiResult:
         from .models import SourceData
         obj = {
             'version': __version__,
-            'datasetMetadata': [item.to_json() for item in
-                                SourceData.query.all()]
+            'datasetMetadata': SourceData.all_to_json()
         }
         if extra_metadata:
             obj.update(extra_metadata)
@@ -85,7 +102,89 @@ class QuerySetApiResult(ApiResult):
             'resultSize': len(record_list),
             'metadata': ApiResult.metadata(extra_metadata)
         }
-        return jsonify(obj)
+        return encode_json(obj)
+
+
+class StreamingApiResult(ApiResult):
+    """A representation of records that are serialized as they are read.
+
+    The response body is written while the records are iterated, so memory
+    use does not grow with their number.
+    """
+
+    mimetypes = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv'
+    }
+
+    def __init__(self, records, return_format, metadata=None):
+        """Store the records and the format.
+
+        Args:
+            records (iterable of dict): The records, e.g. a generator.
+            return_format (str): 'json', 'ndjson' or 'csv'.
+            metadata (dict): Extra metadata for the 'json' format.
+        """
+        super().__init__(records, metadata)
+        self.return_format = return_format
+
+    def to_response(self):
+        """Make a streamed response from the records.
+
+        The first record is read before responding, so that CSV without
+        records is answered with 204 like QuerySetApiResult.
+        """
+        records = iter(self.data)
+        first = next(records, None)
+        if first is None and self.return_format == 'csv':
+            return make_response('', 204)
+        if first is not None:
+            records = chain((first,), records)
+        if self.return_format == 'csv':
+            body = self.csv_chunks(records)
+        elif self.return_format == 'ndjson':
+            body = self.ndjson_chunks(records)
+        else:
+            body = self.json_chunks(records, self.extra_metadata)
+        return Response(stream_with_context(body),
+                        mimetype=self.mimetypes.get(self.return_format,
+                                                    'application/json'))
+
+    @staticmethod
+    def json_chunks(records, extra_metadata):
+        """Yield a JSON object shaped like QuerySetApiResult.json_response."""
+        dumps = current_app.json_backend.dumps
+        yield b'{"results": ['
+        count = 0
+        for record in records:
+            yield b',\n' if count else b'\n'
+            yield dumps(record)
+            count += 1
+        yield b'\n], "resultSize": %d, "metadata": %s}\n' % (
+            count, dumps(ApiResult.metadata(extra_metadata)))
+
+    @staticmethod
+    def ndjson_chunks(records):
+        """Yield one JSON object per line."""
+        dumps = current_app.json_backend.dumps
+        for record in records:
+            yield dumps(record)
+            yield b'\n'
+
+    @staticmethod
+    def csv_chunks(records):
+        """Yield CSV, with a header from the keys of the first record."""
+        string_io = StringIO()
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = DictWriter(f=string_io, fieldnames=record.keys())
+                writer.writeheader()
+            writer.writerow(record)
+            yield string_io.getvalue()
+            string_io.seek(0)
+            string_io.truncate()
 
 
 # TODO: (jef/jkp 2017-08-29) Add methods for:
@@ -0,0 +1,159 @@
+"""Build a new dataset next to the live one, and activate it atomically.
+
+The shadow dataset is a separate file for SQLite, and a separate schema for
+PostgreSQL. It is loaded and its cache warmed while the live dataset keeps
+serving. Activation then swaps the two in one step: the shadow file is
+renamed over the live one, or, in one transaction, the app's live tables are
+moved out of 'public' and its shadow tables moved in. Only the app's own
+tables are moved and dropped, so anything else in 'public' is left alone.
+
+Workers need no restart. SQLite connections to a file are opened per
+checkout, and PostgreSQL resolves table names through the search path on
+every statement, so the next request uses the new dataset. Per-process
+memos are keyed by the source data checksum, so they are rebuilt as well.
+"""
+import copy
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+from . import db
+
+
+# Schema the live dataset is in on PostgreSQL, through the default search
+# path.
+LIVE_SCHEMA = 'public'
+# Schema a new dataset is built in on PostgreSQL.
+SHADOW_SCHEMA = 'pma_shadow'
+# Schema the replaced dataset is moved to on PostgreSQL until it is dropped.
+RETIRED_SCHEMA = 'pma_retired'
+
+
+def replace_url(url, **parts):
+    """Return a copy of a URL with some of its parts replaced.
+
+    URLs are immutable from SqlAlchemy 1.4, which has URL.set instead.
+
+    Args:
+        url (URL): SqlAlchemy URL.
+        **parts: New values of its attributes, e.g. database.
+
+    Returns:
+        URL: The new URL.
+    """
+    if hasattr(url, 'set'):
+        return url.set(**parts)
+    url = copy.copy(url)
+    for name, value in parts.items():
+        setattr(url, name, value)
+    return url
+
+
+def url_string(url):
+    """Return the string of a URL, including any password.
+
+    Args:
+        url (URL): SqlAlchemy URL.
+
+    Returns:
+        str: The URL.
+    """
+    if hasattr(url, 'render_as_string'):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+def shadow_uri(uri):
+    """Return the URI of the shadow dataset of a database.
+
+    Args:
+        uri (str): SqlAlchemy URI of the live database.
+
+    Returns:
+        str: SqlAlchemy URI of the shadow dataset.
+
+    Raises:
+        ValueError: If the database is in memory or neither SQLite nor
+            PostgreSQL.
+    """
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        if not url.database or url.database == ':memory:':
+            raise ValueError('An in-memory database has no shadow dataset.')
+        root, ext = os.path.splitext(url.database)
+        url = replace_url(url, database='{}.shadow{}'.format(root, ext))
+    elif url.drivername.startswith('postgresql'):
+        query = dict(url.query)
+        query['options'] = '-csearch_path={}'.format(SHADOW_SCHEMA)
+        url = replace_url(url, query=query)
+    else:
+        msg = 'Shadow datasets are not supported on "{}".'
+        raise ValueError(msg.format(url.drivername))
+    return url_string(url)
+
+
+def prepare_shadow(uri):
+    """Remove any earlier shadow dataset and make room for a new one.
+
+    Args:
+        uri (str): SqlAlchemy URI of the live database.
+    """
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        path = make_url(shadow_uri(uri)).database
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    engine = create_engine(uri)
+    try:
+        with engine.begin() as connection:
+            connection.execute('DROP SCHEMA IF EXISTS {} CASCADE'
+                               .format(SHADOW_SCHEMA))
+            connection.execute('CREATE SCHEMA {}'.format(SHADOW_SCHEMA))
+    finally:
+        engine.dispose()
+
+
+def activate_shadow(uri):
+    """Replace the live dataset with the shadow dataset.
+
+    The shadow dataset must be complete, and nothing may be connected to it
+    anymore. On PostgreSQL, the tables of the app are moved between schemas
+    with ALTER TABLE ... SET SCHEMA, which keeps their indexes, constraints
+    and sequences.
+
+    Args:
+        uri (str): SqlAlchemy URI of the live database.
+    """
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        os.replace(make_url(shadow_uri(uri)).database, url.database)
+        return
+    names = [table.name for table in db.metadata.sorted_tables]
+    engine = create_engine(uri)
+    try:
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as connection:
+            connection.execute('DROP SCHEMA IF EXISTS {} CASCADE'
+                               .format(RETIRED_SCHEMA))
+            connection.execute('CREATE SCHEMA {}'.format(RETIRED_SCHEMA))
+            for name in names:
+                connection.execute('ALTER TABLE IF EXISTS {}.{} SET SCHEMA {}'
+                                   .format(LIVE_SCHEMA, quote(name),
+                                           RETIRED_SCHEMA))
+            for name in names:
+                connection.execute('ALTER TABLE {}.{} SET SCHEMA {}'
+                                   .format(SHADOW_SCHEMA, quote(name),
+                                           LIVE_SCHEMA))
+        # Dropping waits for queries still reading the old tables, so it is
+        # done after the switch. Without CASCADE, so that it fails rather
+        # than drop anything else that refers to them.
+        with engine.begin() as connection:
+            for name in reversed(names):
+                connection.execute('DROP TABLE IF EXISTS {}.{}'
+                                   .format(RETIRED_SCHEMA, quote(name)))
+            connection.execute('DROP SCHEMA {}'.format(RETIRED_SCHEMA))
+            connection.execute('DROP SCHEMA {}'.format(SHADOW_SCHEMA))
+    finally:
+        engine.dispose()
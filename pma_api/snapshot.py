@@ -0,0 +1,158 @@
+"""Snapshots of the loaded source data as NumPy column arrays.
+
+Parsing the source workbooks is the slowest part of creating a database. A
+snapshot holds the resolved tables instead, with ids, codes, strings,
+translations and data, so that it can be restored with bulk inserts.
+
+A snapshot is an .npz file with one array per column, named
+'<table>.<column>', e.g. 'datum.value'. Columns with NULL values also have
+a boolean array '<table>.<column>.null' that is true where the value is
+NULL. The arrays can be loaded with numpy.load and used as they are, e.g.
+by an in-memory query engine. Source file blobs are not included.
+
+NumPy is an optional dependency, only needed for snapshots.
+"""
+from datetime import datetime
+
+from sqlalchemy import select
+
+from . import db
+from .ingest import BATCH_SIZE, BulkLoader
+from .models import (Characteristic, CharacteristicGroup, Country, Data,
+                     EnglishString, Geography, Indicator, SourceData, Survey,
+                     Translation)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+# Models in a snapshot, in an order where records only refer to earlier ones.
+SNAPSHOT_MODELS = (EnglishString, Geography, Country, Survey,
+                   CharacteristicGroup, Characteristic, Indicator, Translation,
+                   Data, SourceData)
+
+# Placeholder for NULL in each type of column.
+_FILL = {
+    db.Boolean: False,
+    db.DateTime: datetime(1970, 1, 1),
+    db.Float: float('nan'),
+    db.Integer: 0,
+    db.String: ''
+}
+
+
+def snapshot_columns(model):
+    """Return the columns of a model that are stored in snapshots.
+
+    Args:
+        model (class): SqlAlchemy model class.
+
+    Returns:
+        list: SqlAlchemy columns, without binary ones.
+    """
+    return [column for column in model.__table__.columns
+            if not isinstance(column.type, db.LargeBinary)]
+
+
+def column_fill(column):
+    """Return the placeholder for NULL in a column.
+
+    Args:
+        column: SqlAlchemy column.
+
+    Returns:
+        The placeholder value.
+    """
+    for column_type, fill in _FILL.items():
+        if isinstance(column.type, column_type):
+            return fill
+    msg = 'Column "{}" of type {} cannot be stored in a snapshot.'
+    raise TypeError(msg.format(column.name, column.type))
+
+
+def column_arrays(column, values):
+    """Convert the values of a column to NumPy arrays.
+
+    Args:
+        column: SqlAlchemy column.
+        values (list): The values, possibly None.
+
+    Returns:
+        tuple: Array of the values, and boolean array of where they are
+        NULL, or None if none are.
+    """
+    fill = column_fill(column)
+    null = np.array([value is None for value in values], dtype=bool)
+    values = [fill if value is None else value for value in values]
+    if isinstance(column.type, db.DateTime):
+        array = np.array(values, dtype='datetime64[us]')
+    elif isinstance(column.type, db.String):
+        array = np.array(values, dtype=str)
+    else:
+        array = np.array(values, dtype=type(fill))
+    return array, null if null.any() else None
+
+
+def export_snapshot(path):
+    """Write the loaded source data to a snapshot file.
+
+    There must be a current app context.
+
+    Args:
+        path (str): Path to the .npz file to write.
+    """
+    if np is None:
+        raise RuntimeError('NumPy is required for snapshots.')
+    arrays = {}
+    for model in SNAPSHOT_MODELS:
+        table = model.__table__
+        columns = snapshot_columns(model)
+        records = db.session.execute(
+            select(columns).order_by(table.c.id)).fetchall()
+        for i, column in enumerate(columns):
+            name = '{}.{}'.format(table.name, column.name)
+            array, null = column_arrays(column,
+                                        [record[i] for record in records])
+            arrays[name] = array
+            if null is not None:
+                arrays[name + '.null'] = null
+    np.savez_compressed(path, **arrays)
+
+
+def import_snapshot(path):
+    """Load a snapshot file into empty tables, and commit.
+
+    There must be a current app context.
+
+    Args:
+        path (str): Path to the .npz file.
+
+    Returns:
+        int: Number of records loaded.
+    """
+    if np is None:
+        raise RuntimeError('NumPy is required for snapshots.')
+    loader = BulkLoader()
+    count = 0
+    with np.load(path) as arrays:
+        for model in SNAPSHOT_MODELS:
+            table = model.__table__
+            columns = {}
+            for column in snapshot_columns(model):
+                name = '{}.{}'.format(table.name, column.name)
+                values = arrays[name].tolist()
+                if name + '.null' in arrays.files:
+                    values = [None if null else value for value, null
+                              in zip(values, arrays[name + '.null'])]
+                columns[column.name] = values
+            mappings = [dict(zip(columns, values))
+                        for values in zip(*columns.values())]
+            for chunk in range(0, len(mappings), BATCH_SIZE):
+                loader.insert(model, mappings[chunk:chunk + BATCH_SIZE])
+            if mappings:
+                loader.reset_sequence(table.name)
+            count += len(mappings)
+    db.session.commit()
+    return count
@@ -1,5 +1,14 @@
 """Assortment of utilities for application."""
+import hashlib
 import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from flask import g, has_app_context, has_request_context, request
 
 
 random.seed(2020)
@@ -25,3 +34,381 @@ def next64():
         result = ''.join(random.choice(B64_CHAR_SET) for _ in range(n_char))
     _SEEN.add(result)
     return result
+
+
+def hash64(*parts):
+    """Stable string generator.
+
+    Args:
+        *parts (str): Values that identify a record. None is the same as ''.
+
+    Returns:
+        str: String of the same length and characters as from next64, always
+        the same for the same values.
+    """
+    text = '\x1f'.join('' if part is None else str(part) for part in parts)
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=6).digest()
+    number = int.from_bytes(digest, 'big')
+    return ''.join(B64_CHAR_SET[(number >> shift) & 63]
+                   for shift in range(42, -1, -6))
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """Return the md5 checksum of a file, reading it in chunks.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        str: The hex digest.
+    """
+    checksum = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class DatasetMemo:
+    """A per-process value that is rebuilt when the source data changes.
+
+    The loaded dataset only changes when a new source workbook is imported,
+    which is recorded as a new md5 checksum. Expensive, read-only structures
+    derived from the database can therefore be built once and reused until
+    the checksum changes.
+    """
+
+    def __init__(self, build):
+        """Store the build function.
+
+        Args:
+            build (callable): Called with the md5 checksum as its only
+                argument, returns the value to hold.
+        """
+        self.build = build
+        self.held = None
+        self.lock = threading.Lock()
+
+    def get(self, md5):
+        """Return the value for the supplied md5, building it if necessary.
+
+        Args:
+            md5 (str): The md5 checksum of the current source data.
+
+        Returns:
+            The value returned by the build function for this md5.
+        """
+        held = self.held
+        if held is None or held[0] != md5:
+            with self.lock:
+                held = self.held
+                if held is None or held[0] != md5:
+                    held = (md5, self.build(md5))
+                    self.held = held
+        return held[1]
+
+    def clear(self):
+        """Forget the held value so that it is rebuilt on next access."""
+        self.held = None
+
+
+class TimedMemo:
+    """A per-process value, rebuilt once it is older than a time to live.
+
+    Used where a slightly stale value is acceptable in exchange for not
+    querying the database on every request.
+    """
+
+    def __init__(self, build, ttl):
+        """Store the build function.
+
+        Args:
+            build (callable): Called without arguments, returns the value to
+                hold.
+            ttl (float): Seconds the value is kept.
+        """
+        self.build = build
+        self.ttl = ttl
+        self.held = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the held value, building it if missing or expired."""
+        held = self.held
+        if held is None or held[0] < time.monotonic():
+            with self.lock:
+                held = self.held
+                if held is None or held[0] < time.monotonic():
+                    value = self.build()
+                    held = (time.monotonic() + self.ttl, value)
+                    self.held = held
+        return held[1]
+
+    def clear(self):
+        """Forget the held value so that it is rebuilt on next access."""
+        self.held = None
+
+
+class HitTally:
+    """Thread-safe counts of hits per key, written out in batches.
+
+    Counting in memory keeps cache hits free of database writes.
+    """
+
+    def __init__(self):
+        """Initialize with no hits."""
+        self.hits = {}
+        self.drained = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        """Count a hit for a key now.
+
+        Args:
+            key (str): The key.
+        """
+        with self.lock:
+            count, _ = self.hits.get(key, (0, None))
+            self.hits[key] = (count + 1, datetime.utcnow())
+
+    def drain(self, interval=0):
+        """Return and reset the counts, at most once per interval.
+
+        Args:
+            interval (float): Seconds that must have passed since the last
+                drain.
+
+        Returns:
+            list of tuple: (key, number of hits, time of last hit) for each
+            key hit since the last drain. Empty if the interval has not
+            passed.
+        """
+        with self.lock:
+            if time.monotonic() - self.drained < interval:
+                return []
+            hits = [(key, count, last) for key, (count, last)
+                    in self.hits.items()]
+            self.hits = {}
+            self.drained = time.monotonic()
+        return hits
+
+
+# pylint: disable=too-few-public-methods
+class Throttle:
+    """Thread-safe check that lets an action run at most once per interval."""
+
+    def __init__(self):
+        """Initialize as due."""
+        self.last = None
+        self.lock = threading.Lock()
+
+    def due(self, interval):
+        """Return whether the action may run now, and if so count it as run.
+
+        Args:
+            interval (float): Seconds that must have passed since the action
+                last ran.
+
+        Returns:
+            bool: True the first time, and then once the interval has passed.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.last is not None and now - self.last < interval:
+                return False
+            self.last = now
+        return True
+
+
+# pylint: disable=too-few-public-methods
+class Flight:
+    """A computation in progress, waited on by identical calls."""
+
+    def __init__(self):
+        """Initialize an unfinished flight."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# pylint: disable=too-few-public-methods
+class SingleFlight:
+    """Share the result of identical computations running at the same time.
+
+    The first caller for a key computes the result. Callers with the same key
+    that arrive before it finishes wait, and get the same result or error.
+    Nothing is kept once the computation is finished.
+    """
+
+    def __init__(self):
+        """Initialize with no computations in progress."""
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, compute):
+        """Return the result of compute, shared by calls with the same key.
+
+        Args:
+            key: A hashable key identifying the computation.
+            compute (callable): Called without arguments to compute the
+                result.
+
+        Returns:
+            The value returned by compute.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = compute()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def coalesced(func):
+    """Decorate a function so that identical concurrent calls share a result.
+
+    Calls are identical if their arguments have the same repr. Callers must
+    not modify the shared result.
+
+    Args:
+        func (callable): The function to decorate.
+
+    Returns:
+        callable: The decorated function.
+    """
+    flights = SingleFlight()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """Call func, or wait for an identical call in progress."""
+        key = repr((args, sorted(kwargs.items())))
+        return flights.run(key, lambda: func(*args, **kwargs))
+    return wrapper
+
+
+def request_memo(key, build):
+    """Return a value computed at most once per request.
+
+    Outside of a request, the value is computed once per memo_scope block,
+    or on every call if there is none.
+
+    Args:
+        key (str): Name of the value, unique within the application.
+        build (callable): Called without arguments to compute the value.
+
+    Returns:
+        The value returned by build.
+    """
+    if has_request_context():
+        store = request.environ.setdefault('pma_api.request_memo', {})
+    elif has_app_context() and g.get('request_memo') is not None:
+        store = g.request_memo
+    else:
+        return build()
+    if key not in store:
+        store[key] = build()
+    return store[key]
+
+
+@contextmanager
+def memo_scope():
+    """Let request_memo keep values until the block exits, as in a request.
+
+    For commands that serialize many records outside of a request, e.g. to
+    build exports. The data must not be reloaded within the block. There
+    must be a current app context.
+    """
+    outer = g.get('request_memo') is not None
+    if not outer:
+        g.request_memo = {}
+    try:
+        yield
+    finally:
+        if not outer:
+            g.request_memo = None
+
+
+class LruCache:
+    """A thread-safe, least recently used cache.
+
+    The cache is bounded by the total size of its values, and values expire
+    a fixed number of seconds after they are stored.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        """Initialize an empty cache.
+
+        Args:
+            max_bytes (int): Maximum total size of values.
+            ttl (float): Seconds a value is kept.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for a key, or None if missing or expired.
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            The value stored for the key, or None.
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, size, expires = item
+            if expires < time.monotonic():
+                del self.items[key]
+                self.size -= size
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, size):
+        """Store a value, evicting least recently used values if needed.
+
+        Values larger than the whole cache are not stored.
+
+        Args:
+            key (str): The key.
+            value: The value.
+            size (int): Size of the value in bytes.
+        """
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.items.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        """Remove all values."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
@@ -2,6 +2,9 @@
 import os
 
 from pma_api import create_app
+from pma_api.models import Cache
 
 
 app = create_app(os.getenv('FLASK_CONFIG', 'default'))
+with app.app_context():
+    Cache.check_schema()
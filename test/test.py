@@ -1,10 +1,36 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+# pylint: disable=too-many-lines
 """Unit tests."""
+import csv
+import gzip
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
+from io import StringIO
+from unittest import mock
 
-from manage import app
+import xlrd
+from flask import Response, url_for
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+from manage import (ORDERED_MODEL_MAP, SRC_DATA, TRANSLATION_MODEL_MAP,
+                    UI_DATA, app, init_from_workbook, reload_from_workbooks)
+from pma_api import create_app, cube, db, ingest, shadow, snapshot
+from pma_api.api_1_0 import caching, collection, exports, warming
+from pma_api.encoders import ENCODERS
+from pma_api.facets import FacetIndex
+from pma_api.ingest import BulkLoader, WorkbookReader
+from pma_api.models import (Cache, Characteristic, CharacteristicGroup,
+                            Country, Data, EnglishString, Geography,
+                            Indicator, SourceData, Survey, Translation)
+from pma_api.queries import DatalabData
+from pma_api.utils import SingleFlight, Throttle, hash64, memo_scope
 
 
 class TestRoutes(unittest.TestCase):
@@ -41,6 +67,981 @@ class TestRoutes(unittest.TestCase):
             self.app.get(route)
 
 
+@unittest.skipIf(cube.np is None, 'NumPy is not installed.')
+class TestDatalabCube(unittest.TestCase):
+    """Test the in-memory datalab cube."""
+
+    def test_filter_minimal(self):
+        """Cube and database agree on filtered datalab data."""
+        with app.app_context():
+            try:
+                for over_time in (False, True):
+                    app.config['DATALAB_CUBE'] = False
+                    expected = DatalabData.filter_minimal(None, None, None,
+                                                          over_time)
+                    app.config['DATALAB_CUBE'] = True
+                    found = DatalabData.filter_minimal(None, None, None,
+                                                       over_time)
+                    self.assertEqual(expected, found)
+            finally:
+                app.config['DATALAB_CUBE'] = True
+
+    def test_null_order(self):
+        """Cube and database sort NULL orders the same way."""
+        test_app = create_app('testing')
+        with test_app.app_context():
+            db.create_all()
+            try:
+                db.session.add(Geography(
+                    label='National', order=None, type='national',
+                    subheading='National', code='national'))
+                db.session.add(Country(label='Ghana', order=1,
+                                       subregion='West', region='Africa',
+                                       code='GH'))
+                db.session.add(CharacteristicGroup(
+                    label='Residence', order=1, definition='Residence',
+                    category='Demographic', code='residence'))
+                db.session.add(Indicator(
+                    code='ind', label='Indicator', order=1, type='Percent',
+                    definition='Definition', level1='Level 1',
+                    level2='Level 2', domain='Domain',
+                    denominator='All women', measurement_type='Percent',
+                    is_favorite='', favorite_order=None))
+                db.session.commit()
+                for i, order in enumerate((2, None, 1)):
+                    db.session.add(Characteristic(
+                        label='Char {}'.format(i), order=order,
+                        code='char{}'.format(i), char_grp_code='residence'))
+                    db.session.add(Survey(
+                        label='Survey {}'.format(i), order=order,
+                        type='PMA', year=2014, round=i,
+                        start_date='01-2014', end_date='12-2014',
+                        code='GH{}PMA'.format(i), pma_code='GH{}PMA'.format(i),
+                        country_code='GH', geography_code='national',
+                        partner='Partner'))
+                db.session.commit()
+                for i in range(3):
+                    for j in range(3):
+                        db.session.add(Data(
+                            value=i + j / 10, lower_ci=None, upper_ci=None,
+                            level_ci=None, precision=1, is_total=True,
+                            denom_w=None, denom_uw=None,
+                            survey_code='GH{}PMA'.format(i),
+                            indicator_code='ind',
+                            char1_code='char{}'.format(j), char2_code=''))
+                db.session.commit()
+                test_app.config['DATALAB_CUBE'] = False
+                datalab_cube = cube.DatalabCube.from_db(None)
+                for over_time in (False, True):
+                    expected = DatalabData.filter_minimal(None, None, None,
+                                                          over_time)
+                    self.assertEqual(len(expected), 9)
+                    found = datalab_cube.filter_minimal(None, None, None,
+                                                        over_time)
+                    self.assertEqual(expected, found)
+            finally:
+                db.session.remove()
+                db.drop_all()
+
+
+class TestFacetIndex(unittest.TestCase):
+    """Test the facet index of valid datalab selections."""
+
+    @staticmethod
+    def sql_codes(column, *conditions):
+        """Return the sorted distinct codes of a column in datalab data."""
+        query = DatalabData.all_joined(column)
+        for condition in conditions:
+            query = query.filter(condition)
+        return sorted(row[0] for row in query.distinct())
+
+    def test_same_as_sql(self):
+        """Combos and co-occurrences agree with queries of the data."""
+        grp = DatalabData.char_grp1
+        with app.app_context():
+            facets = FacetIndex.from_db(None)
+            surveys = sorted(facets.surveys)
+            for survey_list in ([], surveys[:1], surveys[::2], ['bogus']):
+                by_survey = [Survey.code.in_(survey_list)] if survey_list \
+                    else []
+                for indicator in (None, '', 'mcpr_aw', 'bogus'):
+                    by_indicator = [] if indicator is None \
+                        else [Indicator.code == indicator]
+                    for char_grp in (None, '', 'wealth_quintile', 'bogus'):
+                        by_char_grp = [] if char_grp is None \
+                            else [grp.code == char_grp]
+                        expected = (
+                            self.sql_codes(Survey.code, *by_indicator,
+                                           *by_char_grp),
+                            self.sql_codes(Indicator.code, *by_survey,
+                                           *by_char_grp),
+                            self.sql_codes(grp.code, *by_survey,
+                                           *by_indicator))
+                        self.assertEqual(facets.combos(survey_list,
+                                                       indicator, char_grp),
+                                         expected)
+                indicator_dict, char_grp_dict = \
+                    facets.co_occurring(survey_list)
+                for indicator, char_grps in indicator_dict.items():
+                    self.assertEqual(char_grps, self.sql_codes(
+                        grp.code, Indicator.code == indicator, *by_survey))
+                for char_grp, indicators in char_grp_dict.items():
+                    self.assertEqual(indicators, self.sql_codes(
+                        Indicator.code, grp.code == char_grp, *by_survey))
+                self.assertEqual(sorted(indicator_dict),
+                                 self.sql_codes(Indicator.code, *by_survey))
+
+
+class TestWorkbookReader(unittest.TestCase):
+    """Test reading workbooks row by row."""
+
+    @unittest.skipIf(ingest.openpyxl is None, 'openpyxl is not installed.')
+    def test_rows(self):
+        """Rows are read with the same values as xlrd gives."""
+        sheet = xlrd.open_workbook(SRC_DATA).sheet_by_name('survey')
+        expected = [[cell.value for cell in row] for row in sheet.get_rows()]
+        expected = [row for row in expected if any(row)]
+        with WorkbookReader(SRC_DATA) as reader:
+            self.assertTrue(reader.streaming)
+            self.assertIn('survey', reader.sheet_names())
+            found = list(reader.rows('survey'))
+        self.assertEqual(expected, found)
+
+    def test_processes(self):
+        """Data sheets parsed in worker processes load as in this one."""
+        loaded = []
+        for processes in (None, 2):
+            test_app = create_app('testing')
+            with test_app.app_context():
+                db.create_all()
+                try:
+                    init_from_workbook(SRC_DATA, ORDERED_MODEL_MAP,
+                                       processes)
+                    loaded.append(sorted(
+                        tuple(row) for row in
+                        db.session.execute(Data.__table__.select())))
+                finally:
+                    db.session.remove()
+                    db.drop_all()
+        self.assertTrue(loaded[0])
+        self.assertEqual(loaded[0], loaded[1])
+
+
+@unittest.skipIf(ingest.openpyxl is None, 'openpyxl is not installed.')
+class TestReload(unittest.TestCase):
+    """Test reloading source data in place."""
+
+    @staticmethod
+    def modified_workbook(path):
+        """Write a copy of the API data workbook with changed records.
+
+        Two surveys swap their order, a data row is removed and another
+        changes its value.
+
+        Args:
+            path (str): Path of the copy.
+        """
+        book = ingest.openpyxl.load_workbook(SRC_DATA)
+        surveys = book['survey']
+        surveys['B2'].value, surveys['B3'].value = \
+            surveys['B3'].value, surveys['B2'].value
+        book['data'].delete_rows(2)
+        book['data']['A2'].value = 99.5
+        book.save(path)
+
+    @staticmethod
+    def dataset():
+        """Return the loaded records, without ids.
+
+        Returns:
+            dict: Serialized records of each table, in a stable order.
+        """
+        def by_id(records):
+            """Serialize records in order of their code."""
+            return sorted((record.full_json() for record in records),
+                          key=lambda item: item['id'])
+        return {
+            'data': by_id(Data.query),
+            'survey': by_id(Survey.query),
+            'indicator': by_id(Indicator.query),
+            'english': sorted(text for text, in
+                              db.session.query(EnglishString.english)),
+            'translation': sorted(
+                (lang, text) for lang, text in
+                db.session.query(Translation.language_code,
+                                 Translation.translation)),
+            'source': sorted(md5 for md5, in
+                             db.session.query(SourceData.md5_checksum))
+        }
+
+    def test_reload(self):
+        """Reloading a changed workbook loads what initdb would."""
+        loaded = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'api_data-modified.xlsx')
+            self.modified_workbook(path)
+            for reload in (True, False):
+                test_app = create_app('testing')
+                with test_app.app_context():
+                    db.create_all()
+                    try:
+                        if reload:
+                            init_from_workbook(SRC_DATA, ORDERED_MODEL_MAP)
+                            init_from_workbook(UI_DATA,
+                                               TRANSLATION_MODEL_MAP)
+                            old_md5 = SourceData.get_current_api_md5()
+                            reload_from_workbooks(path, UI_DATA, test_app)
+                            md5 = SourceData.get_current_api_md5()
+                            self.assertNotEqual(md5, old_md5)
+                            self.assertEqual(
+                                Cache.get(caching.KEY_DATALAB_INIT)
+                                .source_data_md5, md5)
+                        else:
+                            init_from_workbook(path, ORDERED_MODEL_MAP)
+                            init_from_workbook(UI_DATA,
+                                               TRANSLATION_MODEL_MAP)
+                        loaded.append(self.dataset())
+                    finally:
+                        db.session.remove()
+                        db.drop_all()
+        self.assertIn(99.5, [item['value'] for item in loaded[0]['data']])
+        for table in loaded[0]:
+            self.assertEqual(loaded[0][table], loaded[1][table])
+
+
+class TestExports(unittest.TestCase):
+    """Test full dataset export files."""
+
+    def test_range(self):
+        """Export files have all data, and can be downloaded in parts."""
+        exports_dir = app.config['EXPORTS_DIR']
+        client = app.test_client()
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['EXPORTS_DIR'] = directory
+            open(os.path.join(directory, '.gitkeep'), 'w').close()
+            try:
+                statements = []
+
+                def record(*args):
+                    """Record an executed SQL statement."""
+                    statements.append(args[2])
+                with app.app_context():
+                    event.listen(db.engine, 'before_cursor_execute', record)
+                    try:
+                        paths = exports.build_exports()
+                    finally:
+                        event.remove(db.engine, 'before_cursor_execute',
+                                     record)
+                    count = Data.query.count()
+                # One query per file, and a few for the source data version
+                # and translations, however many rows and labels.
+                self.assertLess(len(statements), 2 * len(paths))
+                response = client.get('/v1/exports')
+                results = json.loads(response.data.decode('utf-8'))['results']
+                self.assertEqual(len(results), len(paths))
+                whole = client.get(results[0]['url']).data
+                self.assertEqual(len(whole), results[0]['size'])
+                response = client.get(results[0]['url'],
+                                      headers={'Range': 'bytes=10-'})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.data, whole[10:])
+                with gzip.open(paths[0], 'rt') as file:
+                    rows = list(csv.DictReader(file))
+                self.assertEqual(len(rows), count)
+                self.assertIn('lowerCi', rows[0])
+                self.assertIn('char2.id', rows[0])
+            finally:
+                app.config['EXPORTS_DIR'] = exports_dir
+
+    def test_revalidate(self):
+        """The listing is not reused once the files are built."""
+        exports_dir = app.config['EXPORTS_DIR']
+        client = app.test_client()
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['EXPORTS_DIR'] = directory
+            try:
+                empty = client.get('/v1/exports')
+                with app.app_context():
+                    exports.build_exports()
+                response = client.get(
+                    '/v1/exports',
+                    headers={'If-None-Match': empty.headers['ETag']})
+                self.assertEqual(response.status_code, 200)
+                results = json.loads(response.data.decode('utf-8'))['results']
+                self.assertTrue(results)
+                again = client.get(
+                    '/v1/exports',
+                    headers={'If-None-Match': response.headers['ETag']})
+                self.assertEqual(again.status_code, 304)
+            finally:
+                app.config['EXPORTS_DIR'] = exports_dir
+
+
+class TestEncoders(unittest.TestCase):
+    """Test the JSON encoders of responses."""
+
+    def test_same_json(self):
+        """Every installed encoder gives the same JSON, with HTTP dates."""
+        backend = app.json_backend
+        client = app.test_client()
+        bodies = []
+        try:
+            for encoder in ENCODERS.values():
+                if encoder.available():
+                    app.json_backend = encoder
+                    bodies.append(json.loads(
+                        client.get('/version').data.decode('utf-8')))
+        finally:
+            app.json_backend = backend
+        self.assertTrue(bodies[0]['datasetMetadata'][0]['createdOn']
+                        .endswith(' GMT'))
+        for body in bodies[1:]:
+            self.assertEqual(body, bodies[0])
+
+    def test_non_str_keys(self):
+        """Keys that are not strings are encoded like the standard library."""
+        obj = {None: {1: 'one', 2.5: None}}
+        with app.app_context():
+            expected = ENCODERS['json'].dumps(obj)
+            for encoder in ENCODERS.values():
+                if encoder.available():
+                    self.assertEqual(encoder.dumps(obj), expected)
+
+
+class TestShadow(unittest.TestCase):
+    """Test shadow datasets."""
+
+    def test_shadow_uri(self):
+        """Shadow datasets are a separate file or schema."""
+        self.assertEqual(shadow.shadow_uri('sqlite:////srv/pma/dev.db'),
+                         'sqlite:////srv/pma/dev.shadow.db')
+        url = make_url(shadow.shadow_uri('postgresql://pma:pw@localhost/pma'))
+        self.assertEqual(url.password, 'pw')
+        self.assertEqual(url.database, 'pma')
+        self.assertEqual(dict(url.query),
+                         {'options': '-csearch_path=pma_shadow'})
+        with self.assertRaises(ValueError):
+            shadow.shadow_uri('sqlite://')
+
+    @staticmethod
+    def add_geography(uri, code):
+        """Create the tables of a database and add a geography.
+
+        Args:
+            uri (str): SqlAlchemy URI of the database.
+            code (str): Code of the geography.
+        """
+        test_app = create_app('testing', uri)
+        with test_app.app_context():
+            db.create_all()
+            db.session.add(Geography(label=code, order=1, type='national',
+                                     subheading=code, code=code))
+            db.session.commit()
+            db.session.remove()
+            db.get_engine(test_app).dispose()
+
+    @staticmethod
+    def geography_codes(uri):
+        """Return the geography codes of a database.
+
+        Args:
+            uri (str): SqlAlchemy URI of the database.
+
+        Returns:
+            list of str: The codes.
+        """
+        engine = create_engine(uri)
+        try:
+            return [code for code, in
+                    engine.execute('SELECT code FROM geography')]
+        finally:
+            engine.dispose()
+
+    def test_activate_sqlite(self):
+        """The shadow file replaces the live one."""
+        with tempfile.TemporaryDirectory() as directory:
+            uri = 'sqlite:///' + os.path.join(directory, 'live.db')
+            self.add_geography(uri, 'old')
+            self.add_geography(shadow.shadow_uri(uri), 'stale')
+            shadow.prepare_shadow(uri)
+            self.add_geography(shadow.shadow_uri(uri), 'new')
+            self.assertEqual(self.geography_codes(uri), ['old'])
+            shadow.activate_shadow(uri)
+            self.assertEqual(self.geography_codes(uri), ['new'])
+            self.assertEqual(os.listdir(directory), ['live.db'])
+
+    @unittest.skipIf(not os.getenv('TEST_POSTGRESQL_URI'),
+                     'TEST_POSTGRESQL_URI is not set.')
+    def test_activate_postgresql(self):
+        """The shadow tables replace the live ones, and nothing else."""
+        uri = os.getenv('TEST_POSTGRESQL_URI')
+        engine = create_engine(uri)
+        try:
+            engine.execute('DROP TABLE IF EXISTS other')
+            engine.execute('CREATE TABLE other (id INTEGER)')
+            test_app = create_app('testing', uri)
+            with test_app.app_context():
+                db.drop_all()
+                db.session.remove()
+                db.get_engine(test_app).dispose()
+            self.add_geography(uri, 'old')
+            shadow.prepare_shadow(uri)
+            self.add_geography(shadow.shadow_uri(uri), 'new')
+            shadow.activate_shadow(uri)
+            self.assertEqual(self.geography_codes(uri), ['new'])
+            schemas = [name for name, in engine.execute(
+                'SELECT schema_name FROM information_schema.schemata')]
+            self.assertNotIn(shadow.SHADOW_SCHEMA, schemas)
+            self.assertNotIn(shadow.RETIRED_SCHEMA, schemas)
+            # Fails if the table was dropped with the retired ones.
+            engine.execute('DROP TABLE other')
+        finally:
+            engine.dispose()
+
+
+class TestCacheEncoding(unittest.TestCase):
+    """Test content negotiation of cached responses."""
+
+    def test_to_response(self):
+        """Cached bodies are served compressed only if accepted."""
+        body = b'{"resultSize": 0}'
+        record = Cache(key='test', mimetype='application/json')
+        record.compress(body)
+        record.value_brotli = None
+        for accept, encoding in (('', None), ('gzip', 'gzip'),
+                                 ('br, gzip;q=0', None)):
+            headers = {'Accept-Encoding': accept}
+            with app.test_request_context(headers=headers):
+                response = record.to_response()
+            self.assertEqual(response.headers.get('Content-Encoding'),
+                             encoding)
+            data = response.get_data()
+            if encoding == 'gzip':
+                data = gzip.decompress(data)
+            self.assertEqual(data, body)
+
+    def test_xhr_key(self):
+        """Pretty and compact JSON are cached apart."""
+        url = '/v1/datalab/combos?indicator=mcpr_aw'
+        with app.app_context():
+            Cache.query.filter(Cache.key.startswith(url.lstrip('/')))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+        app.local_cache.clear()
+        client = app.test_client()
+        xhr = {'X-Requested-With': 'XMLHttpRequest'}
+        for _ in range(2):
+            pretty = client.get(url).data
+            compact = client.get(url, headers=xhr).data
+            self.assertNotEqual(pretty, compact)
+            self.assertEqual(json.loads(pretty.decode('utf-8')),
+                             json.loads(compact.decode('utf-8')))
+
+
+class TestCacheTrim(unittest.TestCase):
+    """Test stale purging and eviction of the cache table."""
+
+    def setUp(self):
+        """Set up: Create a cache table with one stale and three records."""
+        self.app = create_app('testing')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        records = (('stale', 'old', 0, 1), ('a', 'new', 5, 1),
+                   ('b', 'new', 1, 2), ('c', 'new', 3, 3))
+        for key, source_data_md5, hits, day in records:
+            record = Cache(key=key, mimetype='application/json',
+                           source_data_md5=source_data_md5, hits=hits,
+                           last_accessed=datetime(2018, 1, day))
+            record.compress(key.encode('utf-8') * 100)
+            db.session.add(record)
+        db.session.commit()
+        self.size = Cache.get('a').size
+
+    def tearDown(self):
+        """Tear down: Drop the database."""
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def remaining(self):
+        """Return the sorted keys of the cache table."""
+        return sorted(record.key for record in Cache.query)
+
+    def test_lru(self):
+        """The least recently accessed records are evicted first."""
+        removed = Cache.trim('new', 2 * self.size, 'lru')
+        self.assertEqual(removed, 2)
+        self.assertEqual(self.remaining(), ['b', 'c'])
+
+    def test_lfu(self):
+        """The least hit records are evicted first."""
+        removed = Cache.trim('new', 2 * self.size, 'lfu')
+        self.assertEqual(removed, 2)
+        self.assertEqual(self.remaining(), ['a', 'c'])
+
+    def test_check_schema(self):
+        """A cache table of an older version is reported at startup."""
+        Cache.check_schema()
+        db.session.remove()
+        Cache.__table__.drop(db.engine)
+        Cache.check_schema()
+        db.engine.execute('CREATE TABLE cache (key VARCHAR PRIMARY KEY, '
+                          'value VARCHAR, mimetype VARCHAR, '
+                          'source_data_md5 VARCHAR)')
+        with self.assertRaisesRegex(RuntimeError, '--recreate'):
+            Cache.check_schema()
+
+    def test_save_throttled(self):
+        """Saves trim the table at most once per interval."""
+        self.app.config['CACHE_TRIM_SECONDS'] = 3600
+        with mock.patch.object(caching, '_TRIMS', Throttle()):
+            caching.save_response('d', Response(b'd' * 100), 'new')
+            self.assertNotIn('stale', self.remaining())
+            self.assertIn('d', self.remaining())
+            Cache.query.filter_by(key='a').update({'source_data_md5': 'old'})
+            db.session.commit()
+            caching.save_response('e', Response(b'e' * 100), 'new')
+        self.assertIn('a', self.remaining())
+        self.assertIn('e', self.remaining())
+
+
+class TestWarming(unittest.TestCase):
+    """Test warming the cache table."""
+
+    def test_warm_cache(self):
+        """Every warmed request is answered from the cache table."""
+        test_app = create_app('testing')
+        client = test_app.test_client()
+        xhr = {'X-Requested-With': 'XMLHttpRequest'}
+        with test_app.app_context():
+            db.create_all()
+            try:
+                init_from_workbook(SRC_DATA, ORDERED_MODEL_MAP, 1)
+                count = warming.warm_cache('testing', processes=1)
+                self.assertTrue(count)
+                self.assertEqual(Cache.query.count(), count)
+                source_data_md5 = SourceData.get_current_api_md5()
+                for i, (endpoint, args) in enumerate(
+                        warming.warm_requests()):
+                    with test_app.test_request_context():
+                        url = url_for(endpoint, **args)
+                        fresh_url = url_for(endpoint, cached='false', **args)
+                    with test_app.test_request_context(url, headers=xhr) \
+                            as context:
+                        key = caching.cache_key(context.request.path,
+                                                context.request.args,
+                                                context.request.is_xhr)
+                    self.assertIsNotNone(
+                        Cache.lookup(key, source_data_md5), key)
+                    if i % 10 == 0:
+                        self.assertEqual(
+                            client.get(url, headers=xhr).data,
+                            client.get(fresh_url, headers=xhr).data)
+            finally:
+                db.session.remove()
+                db.drop_all()
+
+
+class TestConditionalGet(unittest.TestCase):
+    """Test validators and 304 responses."""
+
+    def test_not_modified(self):
+        """Repeated requests with validators get 304 without a body."""
+        client = app.test_client()
+        response = client.get('/v1/surveys')
+        self.assertEqual(response.status_code, 200)
+        validators = (
+            {'If-None-Match': response.headers['ETag']},
+            {'If-Modified-Since': response.headers['Last-Modified']}
+        )
+        for headers in validators:
+            again = client.get('/v1/surveys', headers=headers)
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b'')
+        other = client.get('/v1/surveys?lang=fr', headers=validators[0])
+        self.assertEqual(other.status_code, 200)
+        self.assertIn('X-Requested-With', response.headers['Vary'])
+
+    def test_not_found(self):
+        """Validators do not turn an error into 304."""
+        client = app.test_client()
+        headers = {'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT',
+                   'If-None-Match': '*'}
+        response = client.get('/v1/exports/bogus', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test coalescing of identical computations."""
+
+    def test_run(self):
+        """Concurrent calls with one key compute once and share the result."""
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            """Take long enough for the other threads to arrive."""
+            calls.append(None)
+            time.sleep(0.2)
+            return object()
+
+        def call():
+            """Run the computation and keep its result."""
+            results.append(flights.run('key', compute))
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+        flights.run('key', compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_all_minimal_copy(self):
+        """all_minimal does not return the shared result of filter_minimal."""
+        shared = [{'value': 1}]
+        with mock.patch.object(DatalabData, 'filter_minimal',
+                               return_value=shared):
+            results = DatalabData.all_minimal()
+        self.assertEqual(results, shared)
+        self.assertIsNot(results, shared)
+
+
+class DatasetTestCase(unittest.TestCase):
+    """Base of tests on a small dataset in an in-memory database.
+
+    Executed SQL statements are recorded in the statements attribute.
+    """
+
+    # Header of data sheets, see data_sheet.
+    data_header = ['value', 'lower_ci', 'upper_ci', 'level_ci', 'precision',
+                   'is_total', 'denom_w', 'denom_uw', 'survey_code',
+                   'indicator_code', 'char1_code', 'char2_code']
+    # Header of indicator sheets, see indicator_sheet.
+    indicator_header = ['code', 'label', 'order', 'type', 'definition',
+                        'level1', 'level2', 'domain', 'denominator',
+                        'measurement_type', 'is_favorite', 'favorite_order']
+
+    def setUp(self):
+        """Set up: Create an empty in-memory database."""
+        self.app = create_app('testing')
+        self.client = self.app.test_client()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+        db.session.add(Geography(label='National', order=1, type='national',
+                                 subheading='National', code='national'))
+        db.session.add(Country(label='Ghana', order=1, subregion='West',
+                               region='Africa', code='GH'))
+        db.session.add(CharacteristicGroup(label='Residence', order=1,
+                                           definition='Residence',
+                                           category='Demographic',
+                                           code='residence'))
+        db.session.commit()
+        db.session.add(Characteristic(label='Urban', order=1, code='urban',
+                                      char_grp_code='residence'))
+        db.session.commit()
+
+    def tearDown(self):
+        """Tear down: Drop the database."""
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    # pylint: disable=unused-argument,too-many-arguments
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        """Record an executed SQL statement."""
+        self.statements.append(statement)
+
+    @staticmethod
+    def add_data(first, count):
+        """Add surveys and indicators, and data for each combination.
+
+        Args:
+            first (int): Number of the first survey and indicator to add.
+            count (int): Number of surveys and indicators to add.
+        """
+        for i in range(first, first + count):
+            db.session.add(Survey(
+                label='Survey {}'.format(i), order=i, type='PMA', year=2014,
+                round=i, start_date='01-2014', end_date='12-2014',
+                code='GH{}PMA'.format(i), pma_code='GH{}PMA'.format(i),
+                country_code='GH', geography_code='national',
+                partner='Partner'))
+            db.session.add(Indicator(
+                code='ind{}'.format(i), label='Indicator {}'.format(i),
+                order=i, type='Percent', definition='Definition {}'.format(i),
+                level1='Level 1', level2='Level 2', domain='Domain',
+                denominator='All women', measurement_type='Percent',
+                is_favorite='', favorite_order=None))
+        db.session.commit()
+        for i in range(first, first + count):
+            for j in range(1, first + count):
+                db.session.add(Data(
+                    value=10.0, lower_ci=None, upper_ci=None, level_ci=None,
+                    precision=1, is_total=True, denom_w=None, denom_uw=None,
+                    survey_code='GH{}PMA'.format(i),
+                    indicator_code='ind{}'.format(j),
+                    char1_code='urban', char2_code=''))
+        db.session.commit()
+
+    @classmethod
+    def data_sheet(cls, rows):
+        """Return the rows of a data sheet, with its header.
+
+        Args:
+            rows (iterable of tuple): Value, survey code, indicator code,
+                characteristic 1 code and characteristic 2 code of each row.
+
+        Returns:
+            list of list: Cell values.
+        """
+        return [cls.data_header] + [
+            [value, '', '', '', 1.0, 1.0, '', '', survey, indicator, char1,
+             char2] for value, survey, indicator, char1, char2 in rows]
+
+    @classmethod
+    def indicator_sheet(cls, rows):
+        """Return the rows of an indicator sheet, with its header.
+
+        Args:
+            rows (iterable of tuple): Number, order and definition of each
+                indicator.
+
+        Returns:
+            list of list: Cell values.
+        """
+        return [cls.indicator_header] + [
+            ['ind{}'.format(i), 'Indicator {}'.format(i), order, 'Percent',
+             definition, 'Level 1', 'Level 2', 'Domain', 'All women',
+             'Percent', '', ''] for i, order, definition in rows]
+
+
+class TestQueryCount(DatasetTestCase):
+    """Test that reading records uses a constant number of queries."""
+
+    def count_queries(self, route):
+        """Count SQL statements issued to respond to a route.
+
+        The route is requested once first, so that per-process memoized
+        values are already built.
+
+        Args:
+            route (str): Route url.
+
+        Returns:
+            int: Number of SQL statements.
+        """
+        self.client.get(route)
+        db.session.expunge_all()
+        self.statements = []
+        response = self.client.get(route)
+        self.assertEqual(response.status_code, 200)
+        return len(self.statements)
+
+    def test_constant_query_count(self):
+        """Query count does not grow with the number of records."""
+        routes = ('/v1/data', '/v1/surveys', '/v1/indicators',
+                  '/v1/countries')
+        self.add_data(1, 2)
+        few = [self.count_queries(route) for route in routes]
+        self.add_data(3, 4)
+        many = [self.count_queries(route) for route in routes]
+        self.assertEqual(few, many)
+
+    def test_translated_outside_request(self):
+        """Translated records outside a request share the version query."""
+        self.add_data(1, 2)
+        records = Data.query.options(*Data.full_json_loaders()).all()
+        records[0].full_json(lang='fr')
+        counts = []
+        for count in (1, len(records)):
+            with memo_scope():
+                del self.statements[:]
+                for record in records[:count]:
+                    record.full_json(lang='fr')
+                counts.append(len(self.statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_readable_statement(self):
+        """Readable datalab data is read with its labels in one statement."""
+        self.add_data(1, 2)
+        for lang in (None, 'fr'):
+            del self.statements[:]
+            records = DatalabData.filter_readable(None, None, None, lang)
+            self.assertEqual(len(records), 4)
+            self.assertEqual(len(self.statements), 1)
+
+
+class TestCollections(DatasetTestCase):
+    """Test paging and streaming of collection endpoints."""
+
+    def test_pagination(self):
+        """Following next links returns every record once."""
+        self.add_data(1, 3)
+        expected = [code for code, in
+                    db.session.query(Data.code).order_by(Data.id)]
+        found = []
+        url = '/v1/data?limit=4'
+        while url:
+            response = json.loads(self.client.get(url).data.decode('utf-8'))
+            self.assertLessEqual(response['resultSize'], 4)
+            found.extend(result['id'] for result in response['results'])
+            url = response['metadata'].get('next')
+        self.assertEqual(expected, found)
+        self.app.config['PAGE_SIZE_MAX'] = 5
+        response = json.loads(
+            self.client.get('/v1/data?limit=100').data.decode('utf-8'))
+        self.assertEqual(response['resultSize'], 5)
+        for query in ('limit=0', 'limit=-1', 'limit=x', 'after=0',
+                      'after=1.5'):
+            response = self.client.get('/v1/data?' + query)
+            self.assertEqual(response.status_code, 400)
+
+    def test_streaming(self):
+        """Streamed records are the same in every format and chunk size."""
+        self.add_data(1, 3)
+        expected = [code for code, in
+                    db.session.query(Data.code).order_by(Data.id)]
+        chunk_size = collection.STREAM_CHUNK_SIZE
+        collection.STREAM_CHUNK_SIZE = 2
+        try:
+            response = self.client.get('/v1/data?stream=true')
+            results = json.loads(response.data.decode('utf-8'))['results']
+            self.assertEqual([result['id'] for result in results], expected)
+            response = self.client.get('/v1/data?stream=true&format=ndjson')
+            lines = response.data.decode('utf-8').splitlines()
+            self.assertEqual([json.loads(line)['id'] for line in lines],
+                             expected)
+            response = self.client.get('/v1/data?stream=true&format=csv')
+            rows = csv.DictReader(StringIO(response.data.decode('utf-8')))
+            self.assertEqual([row['id'] for row in rows], expected)
+        finally:
+            collection.STREAM_CHUNK_SIZE = chunk_size
+
+    def test_formats(self):
+        """Empty CSV is 204 and unsupported formats are 400."""
+        self.add_data(1, 1)
+        for query, status in (('stream=true&format=csv&survey=none', 204),
+                              ('stream=true&format=json&survey=none', 200),
+                              ('stream=true&format=xml', 400),
+                              ('format=csv', 400), ('format=json', 200)):
+            response = self.client.get('/v1/data?' + query)
+            self.assertEqual(response.status_code, status)
+
+
+class TestBulkLoader(DatasetTestCase):
+    """Test bulk loading and reloading of sheets."""
+
+    def test_bulk_load_query_count(self):
+        """Bulk loading a sheet does not query once per row."""
+        self.add_data(1, 5)
+        # Rows need distinct keys, so vary survey and indicator.
+        rows = [(12.5, 'GH{}PMA'.format(i), 'ind{}'.format(j), '', '')
+                for i in range(1, 6) for j in range(1, 6)]
+        counts = []
+        for first, count in ((0, 2), (2, 20)):
+            del self.statements[:]
+            BulkLoader().load_rows(
+                Data, 'data', self.data_sheet(rows[first:first + count]))
+            counts.append(len(self.statements))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Data.query.filter_by(value=12.5).count(), 22)
+
+    def test_code_collision(self):
+        """Data keys that get the same code get other, stable codes."""
+        self.add_data(1, 2)
+        rows = self.data_sheet((12.5, 'GH1PMA', 'ind{}'.format(j), '', '')
+                               for j in (1, 2))
+        with mock.patch('pma_api.models.hash64', return_value='samecode'):
+            BulkLoader().load_rows(Data, 'data', rows)
+            codes = sorted(code for code, in db.session.query(Data.code)
+                           .filter_by(value=12.5))
+            self.assertEqual(codes, sorted(['samecode',
+                                            hash64('samecode', 1)]))
+            counts = BulkLoader().reload_rows(Data, [('data', rows)])
+        self.assertEqual(counts[:2], (0, 0))
+
+    def test_bulk_load_strings(self):
+        """Bulk loading interns new strings without a statement per string."""
+        counts = []
+        for first, count in ((1, 2), (3, 20)):
+            rows = self.indicator_sheet(
+                (i, i, 'Definition {}'.format(i))
+                for i in range(first, first + count))
+            del self.statements[:]
+            BulkLoader().load_rows(Indicator, 'indicator', rows)
+            counts.append(len(self.statements))
+        self.assertEqual(counts[0], counts[1])
+        indicator = Indicator.query.filter_by(code='ind22').first()
+        self.assertEqual(indicator.label.english, 'Indicator 22')
+        self.assertEqual(indicator.level1.english, 'Level 1')
+        self.assertEqual(EnglishString.query.filter_by(
+            english='Level 1').count(), 1)
+
+    def test_reload_rows(self):
+        """Reloading writes only new, changed and removed records."""
+        self.add_data(1, 2)
+        codes = dict(db.session.query(Data.id, Data.code))
+        rows = self.data_sheet((
+            (10.0, 'GH1PMA', 'ind1', 'urban', ''),
+            (10.0, 'GH1PMA', 'ind2', 'urban', ''),
+            (20.0, 'GH2PMA', 'ind1', 'urban', ''),
+            (30.0, 'GH2PMA', 'ind1', 'urban', 'urban')))
+        # A NULL reference to a string, which must not hide unused ones.
+        db.session.add(CharacteristicGroup(label='Wealth', order=2,
+                                           definition='',
+                                           category='Demographic',
+                                           code='wealth'))
+        db.session.commit()
+        # The definition of ind2 changes, so its old string is unused.
+        indicators = self.indicator_sheet(((1, 2, 'Definition 1'),
+                                           (2, 1, 'New')))
+        loader = BulkLoader()
+        self.assertEqual(loader.reload_rows(
+            Indicator, [('indicator', indicators)]), (0, 2, 0))
+        self.assertEqual(loader.reload_rows(Data, [('data', rows)]),
+                         (1, 1, 1))
+        self.assertEqual(loader.delete_removed(), 1)
+        db.session.commit()
+        self.assertEqual(Indicator.query.filter_by(code='ind1').one().order,
+                         2)
+        self.assertEqual(
+            EnglishString.query.filter_by(english='Definition 2').count(), 0)
+        self.assertEqual(Data.query.count(), 4)
+        for record in Data.query:
+            if record.id in codes:
+                self.assertEqual(record.code, codes[record.id])
+        self.assertEqual(Data.query.filter_by(value=20.0).count(), 1)
+
+
+@unittest.skipIf(snapshot.np is None, 'NumPy is not installed.')
+class TestSnapshot(DatasetTestCase):
+    """Test snapshots of the loaded tables."""
+
+    def test_snapshot(self):
+        """A snapshot restores the same records."""
+        self.add_data(1, 2)
+        expected = [d.full_json() for d in Data.query.order_by(Data.id)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.npz')
+            snapshot.export_snapshot(path)
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            snapshot.import_snapshot(path)
+        found = [d.full_json() for d in Data.query.order_by(Data.id)]
+        self.assertEqual(expected, found)
+
+
 # class TestDB(unittest.TestCase):  # TODO: Adapt from tutorial.
 #     """Test database functionality.
 #